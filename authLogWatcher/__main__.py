@@ -1,13 +1,66 @@
 from twisted.internet import reactor
 from twisted.web import server
+import argparse
 import logging
+import socket
 import sys
 reload(sys)
 sys.setdefaultencoding("utf-8")
 
 # App modules
 import authLogWatcher
+import aggregator
+import blocklist
+import parsers
 import rpcServe
+import stream
+
+# Arguments...
+argParser = argparse.ArgumentParser(description='Watch auth logs and serve events to clients.')
+argParser.add_argument('--source', action='append', metavar='PATH[:PARSER]',
+                       help='A log file (or glob pattern) to watch, optionally with the '
+                            'parser to use (%s; default sshd). May be given many times. '
+                            'Default: /var/log/auth.log' % ", ".join(sorted(parsers.PARSERS)))
+argParser.add_argument('--port', type=int, default=7080,
+                       help='Port to serve the RPC API on (default 7080)')
+argParser.add_argument('--stream-port', type=int, default=7081,
+                       help='Port to stream events to aggregators on (default 7081)')
+argParser.add_argument('--name', default=socket.gethostname(),
+                       help='Name of this watcher as seen by aggregators (default hostname)')
+argParser.add_argument('--cache', default=authLogWatcher.cacheFile,
+                       help='Host info cache file (default %s)' % authLogWatcher.cacheFile)
+argParser.add_argument('--export-dir', default='exports',
+                       help='Directory exports are written to (default ./exports)')
+argParser.add_argument('--block', action='append', metavar='THRESHOLD/WINDOW[/PREFIX][:MATCH]',
+                       help='Block hosts reaching THRESHOLD failed attempts within WINDOW seconds, '
+                            'counted per address or per network of the given PREFIX length, or '
+                            'instead events of any kind whose message contains MATCH (e.g. 5/60 or '
+                            '50/600/24:"Invalid user"). May be given many times.')
+argParser.add_argument('--block-allow', action='append', metavar='ADDRESS[/PREFIX]',
+                       help='An address or network never to block. May be given many times. '
+                            'Loopback and private networks are always allowed.')
+argParser.add_argument('--block-duration', type=int, default=3600,
+                       help='Seconds each block lasts (default 3600)')
+argParser.add_argument('--ipset', default='authlog',
+                       help='The ipset blocks are added to (default authlog)')
+argParser.add_argument('--block-dry-run', action='store_true',
+                       help='Log blocks instead of applying them')
+argParser.add_argument('--aggregate', nargs='+', metavar='HOST:PORT',
+                       help='Run as an aggregator of the given watchers (their stream ports) '
+                            'instead of watching log files')
+args = argParser.parse_args()
+authLogWatcher.cacheFile = args.cache
+
+rules = [blocklist.parseRule(spec, args.block_duration) for spec in args.block or ()]
+
+sources = None
+if args.source:
+    sources = []
+    for source in args.source:
+        path, parserName = source, "sshd"
+        if ":" in source and source.rsplit(":", 1)[1] in parsers.PARSERS:
+            path, parserName = source.rsplit(":", 1)
+        sources.append((path, parserName))
 
 # Logging...
 handler = logging.StreamHandler(sys.stdout)
@@ -21,10 +74,28 @@ appLogger = logging.getLogger("AuthLogWatcher")
 
 
 # Get ready...
-watcher = authLogWatcher.AuthLogWatcher() # setup the auth.log watcher
-watcher.start() # start watching the auth.log
-clientResponder = rpcServe.AuthXMLRPCResponder(watcher) # setup the client protocol
-reactor.listenTCP(7080, server.Site(clientResponder) ) # accept clients
+watcher = None
+if args.aggregate:
+    nodes = []
+    for address in args.aggregate:
+        host, port = address.rsplit(":", 1)
+        nodes.append((host, int(port)))
+
+    merger = aggregator.Aggregator(nodes) # setup the watcher subscriptions
+    merger.start() # start connecting to the watchers
+    clientResponder = rpcServe.AggregatorXMLRPCResponder(merger, args.export_dir) # setup the client protocol
+else:
+    blocks = None
+    if rules:
+        executor = blocklist.DryRunExecutor() if args.block_dry_run else blocklist.IpsetExecutor(args.ipset)
+        allow = blocklist.DEFAULT_ALLOW + tuple(args.block_allow or ())
+        blocks = blocklist.Blocklist(rules, executor, allow=allow) # setup the blocking rules
+
+    watcher = authLogWatcher.AuthLogWatcher(sources, blocks) # setup the log watcher
+    watcher.start() # start watching the log files
+    clientResponder = rpcServe.AuthXMLRPCResponder(watcher, args.export_dir) # setup the client protocol
+    reactor.listenTCP(args.stream_port, stream.EventStreamFactory(watcher, args.name)) # accept aggregators
+reactor.listenTCP(args.port, server.Site(clientResponder) ) # accept clients
 
 # Go!...
 try:
@@ -34,5 +105,6 @@ except KeyboardInterrupt:
 except:
     appLogger.critical("Fatal", exc_info=True)
 finally:
-    watcher.saveCache()
+    if watcher:
+        watcher.saveCache()
 print "Bye!"
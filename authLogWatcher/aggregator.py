@@ -0,0 +1,326 @@
+from twisted.internet import reactor, protocol
+import logging
+import time
+
+import eventStore
+import loadShedder
+import publisher
+import stream
+
+HISTORY_LENGTH = 4000
+
+class NodeStreamProtocol(stream.JSONLineProtocol):
+    """ The aggregator end of the event stream from a single watcher.
+    """
+
+    def connectionMade(self):
+        self.logger = logging.getLogger("Aggregator")
+        self.node = self.factory
+        self.node.resetDelay()
+        self.node.streamConnected(self)
+
+    def connectionLost(self, reason):
+        self.node.streamLost(self)
+
+    def message_hello(self, message):
+        self.node.hello(message)
+
+    def message_snapshot(self, message):
+        self.node.aggregator.nodeSnapshot(self.node, message)
+
+    def message_event(self, message):
+        self.node.aggregator.nodeEvent(self.node, message["event"])
+
+    def message_count(self, message):
+        self.node.aggregator.nodeCount(self.node, message)
+
+    def message_load(self, message):
+        self.node.aggregator.nodeLoad(self.node, message)
+
+    def message_hostinfo(self, message):
+        self.node.aggregator.nodeHostInfo(self.node, message["hostinfo"])
+
+class WatcherNode(protocol.ReconnectingClientFactory):
+    """
+    A single watcher which the aggregator subscribes to. Keeps the epoch and
+    sequence number of the last event seen (to catch up after reconnecting)
+    along with this node's share of the aggregated counters (to replace it
+    when the node sends a new snapshot).
+
+    Nodes are told apart by the address they are subscribed at (the node
+    field of their events), the name they report is only for display as
+    several watchers may share one (e.g. the hostname).
+    """
+    protocol = NodeStreamProtocol
+    maxDelay = 60
+
+    def __init__(self, aggregator, host, port):
+        self.aggregator = aggregator
+        self.host = host
+        self.port = port
+        self.address = "%s:%d" % (host, port)
+        self.name = self.address
+
+        self.connection = None
+        self.lastSeen = None
+        self.sources = []
+        self.load = None
+
+        # Where the stream left off
+        self.epoch = None
+        self.seq = 0
+
+        # This node's share of the aggregate
+        self.eventCount = 0
+        self.hostMessages = {}
+
+    def streamConnected(self, connection):
+        self.connection = connection
+        self.lastSeen = time.time()
+        connection.sendMessage({ "type": "subscribe", "epoch": self.epoch, "seq": self.seq })
+        self.aggregator.nodeConnected(self)
+
+    def streamLost(self, connection):
+        if self.connection is connection:
+            self.connection = None
+        self.aggregator.logger.warning("Lost node %s" % self.name)
+
+    def hello(self, message):
+        self.lastSeen = time.time()
+        self.name = message.get("node") or self.address
+        self.sources = message.get("sources", [])
+
+        for other in self.aggregator.nodes:
+            if other is not self and other.name == self.name:
+                self.aggregator.logger.warning("Nodes %s and %s are both named %s" %
+                                               (other.address, self.address, repr(self.name)))
+
+    def sendMessage(self, message):
+        if self.connection:
+            self.connection.sendMessage(message)
+
+    def status(self):
+        return { "node": self.name,
+                 "address": self.address,
+                 "connected": self.connection is not None,
+                 "lastSeen": self.lastSeen,
+                 "seq": self.seq,
+                 "eventCount": self.eventCount,
+                 "hosts": len(self.hostMessages),
+                 "load": self.load
+        }
+
+class Aggregator(publisher.Publisher):
+    """
+    Subscribes to the event streams of many AuthLogWatchers and merges them
+    into a single set of data stores, which can be served to clients exactly
+    as a single watcher would (see AuthXMLRPCResponder).
+
+    All nodes are handled by the one reactor (no thread per node) and are
+    reconnected with a backoff when lost. Host info received from any node is
+    shared with every other node so that an address is not geolocated again
+    by each node seeing it later on. Nodes do not check with the aggregator
+    before a lookup, so several nodes seeing a new address at once (e.g. a
+    scanner) each look it up.
+
+    While any node is sampling, only a sample of the events is published to
+    clients, each standing for the events skipped (or only counted) since the
+    last, as a watcher does.
+
+    Watcher (x N)                  Aggregator                   AuthLogClient
+         | <---- subscribe ------------ |                             |
+         | ----- snapshot / events ---> |                             |
+         |                              | ---- sendEvent() ---------> |
+         | <---- hostinfo (shared) ---- |                             |
+         ...                            ...                           ...
+    """
+
+    # { host : { message : count }}
+    hostMessages = None
+
+    # { host : {response} }
+    hostInfo = None
+
+    # Event count
+    eventCount = 0
+
+    def __init__(self, addresses):
+        publisher.Publisher.__init__(self)
+        self.logger = logging.getLogger("Aggregator")
+
+        self.hostMessages = {}
+        self.hostInfo = {}
+        self.eventHistory = []
+        self.eventStore = eventStore.EventStore()
+
+        # Samples the events published to clients at the level of the most
+        # loaded node (the load is not measured here, so it is never started)
+        self.sampler = loadShedder.LoadShedder(None, None)
+
+        # [ WatcherNode ]
+        self.nodes = [WatcherNode(self, host, port) for host, port in addresses]
+
+    def start(self):
+        """ Connect to every node.
+        """
+        for node in self.nodes:
+            self.logger.info("Connecting to node %s" % node.name)
+            reactor.connectTCP(node.host, node.port, node)
+
+    def getNodes(self):
+        return [node.status() for node in self.nodes]
+
+    def getSources(self):
+        sources = []
+        for node in self.nodes:
+            for source in node.sources:
+                source = dict(source)
+                source["node"] = node.address
+                source["nodeName"] = node.name
+                sources.append(source)
+        return sources
+
+    def nodeConnected(self, node):
+        """ Give a (re)connected node all host info known so far.
+        """
+        self.logger.info("Connected to node %s" % node.name)
+        if self.hostInfo:
+            node.sendMessage({ "type": "hostinfo", "hostinfo": self.hostInfo })
+
+    def countMessages(self, hostMessages, sign):
+        """ Add (sign=1) or remove (sign=-1) the given counts from the aggregate.
+        """
+        for host, messages in hostMessages.items():
+            aggregateMessages = self.hostMessages.setdefault(host, {})
+            for message, count in messages.items():
+                aggregateMessages[message] = aggregateMessages.get(message, 0) + sign*count
+                if aggregateMessages[message] <= 0:
+                    del aggregateMessages[message]
+            if not aggregateMessages:
+                del self.hostMessages[host]
+
+    def nodeSnapshot(self, node, snapshot):
+        """ Replace the node's share of the aggregate with the given snapshot.
+        """
+        node.lastSeen = time.time()
+
+        self.countMessages(node.hostMessages, -1)
+        self.eventCount -= node.eventCount
+
+        node.hostMessages = snapshot["hostMessages"]
+        node.eventCount = snapshot["eventCount"]
+        node.epoch = snapshot["epoch"]
+        node.seq = snapshot["seq"]
+
+        self.countMessages(node.hostMessages, 1)
+        self.eventCount += node.eventCount
+
+        self.nodeHostInfo(node, snapshot["hostInfo"])
+
+        # Replace the node's recent history (and its events in the store) in ours
+        for eventData in snapshot["history"]:
+            eventData["node"] = node.address
+            if eventData["host"] in self.hostInfo:
+                eventData["hostinfo"] = self.hostInfo[eventData["host"]]
+        self.eventStore.replaceRows(self.eventStore.selectRows({ "node": node.address }),
+                                    snapshot["history"])
+        self.eventHistory = [eventData for eventData in self.eventHistory
+                             if eventData.get("node") != node.address]
+        self.eventHistory.extend(snapshot["history"])
+        self.eventHistory.sort(key=lambda eventData: eventData["time"])
+        del self.eventHistory[:-HISTORY_LENGTH]
+
+        self.logger.info("Snapshot from node %s: %d events, %d hosts" %
+                         (node.name, node.eventCount, len(node.hostMessages)))
+
+    def countEvent(self, node, countData):
+        """ Count an event (or count-only message) from the node, returning
+        False if it has been counted before (e.g. replayed after a reconnect).
+        """
+        node.lastSeen = time.time()
+
+        if countData["seq"] <= node.seq:
+            return False
+        node.seq = countData["seq"]
+
+        host, template = countData["host"], countData["template"]
+        for hostMessages in (node.hostMessages, self.hostMessages):
+            messages = hostMessages.setdefault(host, {})
+            messages[template] = messages.get(template, 0) + 1
+
+        node.eventCount += 1
+        self.eventCount += 1
+        return True
+
+    def nodeCount(self, node, countData):
+        """ Count a repeat message the node is only counting (under load), to
+        be stood for by the next event published.
+        """
+        if self.countEvent(node, countData):
+            self.sampler.countOnlyEvent()
+
+    def nodeLoad(self, node, status):
+        """ Record the node's load shedding status and pass on the overall status.
+        """
+        node.load = status
+
+        status = self.getLoadStatus()
+        self.sampler.level = status["level"]
+        self.publish("sendLoadLevel", status)
+
+    def getLoadStatus(self):
+        """ The load shedding status of the most loaded node.
+        """
+        statuses = [node.load for node in self.nodes if node.load]
+        if not statuses:
+            return { "type": "load", "level": 0, "name": "normal" }
+
+        status = dict(max(statuses, key=lambda status: status["level"]))
+        status["nodes"] = dict((node.address, node.load["level"]) for node in self.nodes if node.load)
+        return status
+
+    def nodeEvent(self, node, eventData):
+        """ Add an event from the node to the aggregate and notify subscribers.
+        """
+        if not self.countEvent(node, eventData):
+            return
+
+        eventData["node"] = node.address
+        host = eventData["host"]
+        if host in self.hostInfo:
+            eventData["hostinfo"] = self.hostInfo[host]
+
+        self.eventStore.addEvent(eventData)
+        self.eventHistory.append(eventData)
+        while len(self.eventHistory) > HISTORY_LENGTH:
+            self.eventHistory.pop(0)
+
+        # Only a sample of events are published under heavy load (each
+        # standing for 'weight' events)
+        weight = self.sampler.sample()
+        if weight == 1:
+            self.publish("sendEvent", eventData)
+        elif weight:
+            self.publish("sendEvent", dict(eventData, weight=weight))
+
+    def nodeHostInfo(self, node, hostInfo):
+        """ Record host info from the node, sharing anything new with the
+        other nodes and subscribers.
+        """
+        newHostInfo = {}
+        for ipAddress, hostObj in hostInfo.items():
+            if ipAddress not in self.hostInfo:
+                self.hostInfo[ipAddress] = hostObj
+                newHostInfo[ipAddress] = hostObj
+                self.eventStore.setHostInfo(ipAddress, hostObj)
+
+                self.publish("sendHostUpdate", { "type": "host",
+                                                 "time": time.time(),
+                                                 "host": ipAddress,
+                                                 "hostinfo": hostObj
+                })
+
+        if newHostInfo:
+            for otherNode in self.nodes:
+                if otherNode is not node:
+                    otherNode.sendMessage({ "type": "hostinfo", "hostinfo": newHostInfo })
@@ -1,29 +1,54 @@
 from twisted.internet import reactor
 import cPickle as pickle
-import requests
 import logging
 import time
 import json
-import re
+import glob
+import uuid
 
+import eventStore
 import fileWatcher
+import hostLookup
+import loadShedder
 import publisher
-
-# Patterns to search for in line events (from the auth.log)
-sshPattern = re.compile(r'.*sshd\[\d+\]: (?P<message>.*)')
-ipPattern = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-portPattern = re.compile(r'.* port (?P<port>\d+).*')
-quotedPattern = re.compile(r"['\"].+['\"]")
+import parsers
 
 # Misc.
 cacheFile = "hostInfo.cache"
 HISTORY_LENGTH = 4000
 
-class AuthLogWatcher(fileWatcher.FileWatcher, publisher.Publisher):
+class LogSource(fileWatcher.FileWatcher):
+    """
+    Tails a single log file for the AuthLogWatcher, parsing each line with the
+    parser for the daemon writing the file.
+    """
+
+    def __init__(self, watchPath, parser, watcher):
+        fileWatcher.FileWatcher.__init__(self, watchPath)
+        self.parser = parser
+        self.watcher = watcher
+        self.lineCount = 0
+
+    def linesReceived(self, lines):
+        self.lineCount += len(lines)
+        lineReceived = self.watcher.lineReceived
+        for line in lines:
+            lineReceived(line, self.parser)
+
+    def lineReceived(self, line):
+        self.lineCount += 1
+        self.watcher.lineReceived(line, self.parser)
+
+class AuthLogWatcher(publisher.Publisher):
     """
     Watches events written to the auth.log, parses each event, and adds the
     event/host info to internal stores. Note: 192.168.* addresse are ignored!
 
+    Any number of other log files (sources) can be watched as well, each with
+    the parser for the daemon writing it (see parsers.py). Paths may be glob
+    patterns. All sources share a single iNotify instance and feed the same
+    stores and subscribers.
+
     The AuthLogWatcher (this class) accepts subscriptions from clients wishing
     to get auth.log event updates (AuthLogClients). The clients setup an RPC
     connection for the watcher to respond on.
@@ -35,12 +60,22 @@ class AuthLogWatcher(fileWatcher.FileWatcher, publisher.Publisher):
     ---> x (auth.log event)              |
          | ---- sendEvent() -----------> |
          |                               | ---> (display)
+    ---> x (host info fetched)           |
+         | ---- sendHostUpdate() ------> |
+         |                               | ---> (display)
          ...                             ...
 
+    Host info is fetched in the background (see HostLookup), so events for
+    hosts which have not been geolocated yet are published with only the
+    address in their host info; the full record follows as a host update.
+
     """
 
     watchPath = "/var/log/auth.log"
 
+    # The parser used for watchPath
+    parserName = "sshd"
+
     # set of IP addresses
     observedHosts = None
 
@@ -59,16 +94,81 @@ class AuthLogWatcher(fileWatcher.FileWatcher, publisher.Publisher):
     # Event count
     eventCount = 0
 
-    def __init__(self):
+    # Sequence number of the last event, unique within the epoch (a single run
+    # of the watcher). Used by aggregators to catch up after reconnecting.
+    sequence = 0
+    epoch = None
+
+    def __init__(self, sources=None, blocklist=None):
         self.hostMessages = {}
         self.eventHistory = []
+        self.eventStore = eventStore.EventStore()
+        self.epoch = uuid.uuid4().hex
 
         self.logger = logging.getLogger("AuthLogWatcher")
         self.hostInfo = self.getCache()
+        self.hostLookup = hostLookup.HostLookup(self.hostInfo, self.hostInfoReceived)
+        self.loadShedder = loadShedder.LoadShedder(self.getLoad, self.loadLevelChanged)
+
+        # Blocks hosts reaching the rule thresholds (optional)
+        self.blocklist = blocklist
 
-        fileWatcher.FileWatcher.__init__(self, self.watchPath)
         publisher.Publisher.__init__(self)
 
+        # [ (path or pattern, parser name) ]
+        if sources is None:
+            sources = [(self.watchPath, self.parserName)]
+
+        self.watchers = fileWatcher.FileWatcherGroup()
+        for path, parserName in sources:
+            self.addSource(path, parserName)
+
+    def addSource(self, path, parserName):
+        """ Watch the given log file (or every file matching the given glob
+        pattern) using the named parser.
+        """
+        parser = parsers.getParser(parserName)
+
+        if glob.has_magic(path):
+            self.watchers.addPattern(path, lambda match: LogSource(match, parser, self))
+        else:
+            self.watchers.addWatcher(LogSource(path, parser, self))
+
+    def getSources(self):
+        """ Return a description of each watched log file.
+        """
+        return [ { "path": source.watchPath,
+                   "parser": source.parser.name,
+                   "lines": source.lineCount,
+                   "backlog": source.backlog() if source.file else 0 }
+                 for source in self.watchers.watchers.values() ]
+
+    def getLoad(self):
+        """ Return the bytes left to read from the log files and the number
+        of host lookups ready to be made.
+        """
+        backlog = sum(source.backlog() for source in self.watchers.watchers.values()
+                      if source.file)
+        return backlog, self.hostLookup.waiting()
+
+    def getLoadStatus(self):
+        return self.loadShedder.status()
+
+    def loadLevelChanged(self, status):
+        """ Let subscribers know the load shedding level has changed.
+        """
+        self.publish("sendLoadLevel", status)
+
+    def start(self):
+        """ Start watching the log files, looking up host info and checking
+        the load.
+        """
+        self.hostLookup.start()
+        self.loadShedder.start()
+        if self.blocklist:
+            self.blocklist.start()
+        self.watchers.start()
+
     def getCache(self):
         """ Fetches hostInfo cache from disk.
         """
@@ -106,19 +206,33 @@ class AuthLogWatcher(fileWatcher.FileWatcher, publisher.Publisher):
 
     def addHostInfo(self, ipAddress):
         """ Record the host info to data store. If this is a novel host, then
-        the IP info is fetched from ipinfo.io.
+        the IP info is scheduled to be fetched from ipinfo.io.
         """
-        try:
+        self.hostLookup.lookup(ipAddress)
+
+    def hostInfoReceived(self, ipAddress, hostObj):
+        """ Respond to newly fetched host info by notifying subscribers.
+        """
+        print self.displayHostInfo(ipAddress)
+
+        self.eventStore.setHostInfo(ipAddress, hostObj)
+
+        updateData = { "type": "host",
+                       "time": time.time(),
+                       "host": ipAddress,
+                       "hostinfo": hostObj
+        }
+
+        self.publish("sendHostUpdate", updateData)
+
+    def addSharedHostInfo(self, hostInfo):
+        """ Record host info fetched elsewhere (e.g. by another watcher, as
+        shared by an aggregator) so that it is not fetched again here.
+        """
+        for ipAddress, hostObj in hostInfo.items():
             if ipAddress not in self.hostInfo:
-                retObj = requests.get("http://ipinfo.io/"+ipAddress+"/json")
-                if retObj.status_code == 200:
-                    self.hostInfo[ipAddress] = retObj.json()
-                    print self.displayHostInfo(ipAddress)
-                else:
-                    self.logger.warning("Non-200 HTTP response while fetching IP Info!")
-        except:
-            self.logger.warning("Error while fetching IP Info!", exc_info=True)
-            raise
+                self.hostInfo[ipAddress] = hostObj
+                self.hostInfoReceived(ipAddress, hostObj)
 
     def displayHostInfo(self, ipAddress):
         """ Return a string representing the host information for the given address.
@@ -136,78 +250,97 @@ class AuthLogWatcher(fileWatcher.FileWatcher, publisher.Publisher):
 
         return hostInfoStr
 
-    def handleLine(self, line):
-        """ Parse the given auth.log line and return an event object to be published.
+    def handleLine(self, line, parser=None):
+        """ Parse the given log line (with the sshd parser by default) and
+        return an event object to be published.
+
+        Under heavy load (see LoadShedder) known hosts are not looked up or
+        logged, and repeat messages are only counted: no event object is made
+        and only subscribers needing exact counts (aggregators) are told.
         """
-        sshMatch = sshPattern.search(line)
-
-        # Only match on sshd events
-        if sshMatch:
-            message = sshMatch.group('message')
-            sanitizedMessage = quotedPattern.sub('', message)
-
-            ipAddress = None
-            ipPort = None
-
-            # Determine if there is an IP address in the line
-            ipMatch = ipPattern.search(message)
-            if ipMatch:
-                ipAddress = ipMatch.group(0)
-                sanitizedMessage = sanitizedMessage.replace(ipAddress, "")
-
-                # Not interested in local boxes access
-                if "192.168." in ipAddress:
-                    return
-
-            # Determine if there is an IP port in the line
-            portMatch = portPattern.search(message)
-            if portMatch:
-                ipPort = portMatch.group('port')
-                sanitizedMessage = sanitizedMessage.replace(ipPort, "")
-
-            # Take action if there was a remote auth.log event
-            if ipAddress:
-                # Add host & host info to the store
-                self.addEvent(ipAddress, sanitizedMessage)
+        if parser is None:
+            parser = parsers.getParser(self.parserName)
+
+        # Lines are read as bytes which need not be UTF-8 (e.g. a user name
+        # sent by the client), they must be to be published
+        if isinstance(line, str):
+            line = line.decode("utf-8", "replace")
+
+        parsed = parser.parse(line)
+
+        # Only match on lines with a remote host
+        if parsed:
+            ipAddress, message, sanitizedMessage = parsed
+
+            # Not interested in local boxes access
+            if "192.168." in ipAddress:
+                return
+
+            knownHost = ipAddress in self.hostMessages
+            repeat = knownHost and sanitizedMessage in self.hostMessages[ipAddress]
+
+            # Add host to the store
+            self.addEvent(ipAddress, sanitizedMessage)
+            if self.blocklist:
+                self.blocklist.addEvent(ipAddress, sanitizedMessage,
+                                        parser.isFailure(message))
+
+            self.eventCount += 1
+            self.sequence += 1
+
+            if repeat and self.loadShedder.countOnly():
+                self.loadShedder.countOnlyEvent()
+                self.publish("sendCount", { "type": "count",
+                                            "host": ipAddress,
+                                            "template": sanitizedMessage,
+                                            "seq": self.sequence
+                }, exact=True)
+                return
+
+            if not (knownHost and self.loadShedder.skipEnrichment()):
+                # Add host info to the store
                 self.addHostInfo(ipAddress)
 
                 # Log the action
                 hostStr = self.displayHostInfo(ipAddress)
-                self.logger.info("Processed Line: %s\n%s" % (str(line),
-                                                             str(hostStr)))
-
-                # Make event data for publishing
-                eventData = { "time": time.time(),
-                              "hostinfo": self.hostInfo[ipAddress],
-                              "message": message
-                }
+                self.logger.info("Processed Line: %s\n%s" % (line, hostStr))
 
-                self.eventCount += 1
+            # Make event data for publishing
+            eventData = { "time": time.time(),
+                          "hostinfo": self.hostInfo.get(ipAddress, {"ip": ipAddress}),
+                          "message": message,
+                          "source": parser.name,
+                          "host": ipAddress,
+                          "template": sanitizedMessage,
+                          "seq": self.sequence
+            }
 
-                return eventData
+            return eventData
 
 
-    def lineReceived(self, line):
+    def lineReceived(self, line, parser=None):
         """ Respond to the inotify event by passing any newly observed
         lines to the handler thread.
         """
         try:
-            eventData = self.handleLine(line)
+            eventData = self.handleLine(line, parser)
 
             if eventData:
                 # Store history
+                self.eventStore.addEvent(eventData)
                 self.eventHistory.append(eventData)
                 while len(self.eventHistory) > HISTORY_LENGTH:
                     self.eventHistory.pop(0)
 
-                # Notify subscribers
-                for key, subscriber in self.subscribers.items():
-                    try:
-                        subscriber.sendEvent(eventData)
-                    except:
-                        # unsubscrive dead clients
-                        self.logger.warning("Dead client: %s" % repr(key))
-                        self.unsubscribe(key)
+                # Notify subscribers, only a sample of events are published
+                # to clients under heavy load (each standing for 'weight' events)
+                self.publish("sendEvent", eventData, exact=True)
+
+                weight = self.loadShedder.sample()
+                if weight == 1:
+                    self.publish("sendEvent", eventData, exact=False)
+                elif weight:
+                    self.publish("sendEvent", dict(eventData, weight=weight), exact=False)
         except:
             self.logger.critical("Error receiving line!", exc_info=True)
             raise
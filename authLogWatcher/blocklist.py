@@ -0,0 +1,301 @@
+from twisted.internet import reactor, protocol, defer, task
+import collections
+import logging
+import socket
+import struct
+
+# Networks never blocked (loopback and private ranges)
+DEFAULT_ALLOW = ("127.0.0.0/8", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16")
+
+def parseNetwork(spec):
+    """ Return the (address, mask) integers of the given address or network
+    in CIDR notation, e.g. "203.0.113.7" or "203.0.113.0/24".
+    """
+    address, prefix = spec, 32
+    if "/" in spec:
+        address, prefix = spec.split("/", 1)
+
+    try:
+        prefix = int(prefix)
+        if not 0 <= prefix <= 32:
+            raise ValueError()
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        return struct.unpack("!I", socket.inet_aton(address))[0] & mask, mask
+    except (ValueError, socket.error):
+        raise ValueError("Bad network %s (expected ADDRESS[/PREFIX])" % repr(spec))
+
+class WindowCounters(object):
+    """
+    Counts events per key over a sliding window. The window is split into a
+    few buckets so that each key only needs a handful of (bucket, count)
+    pairs, and the least recently seen keys are forgotten beyond maxKeys so
+    that memory stays bounded however many addresses are seen.
+    """
+
+    def __init__(self, window, buckets=6, maxKeys=100000):
+        self.buckets = buckets
+        self.bucketWidth = float(window) / buckets
+        self.maxKeys = maxKeys
+
+        # { key : [ [bucket, count], ... ] } least recently seen first
+        self.counters = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.counters)
+
+    def add(self, key, now):
+        """ Count an event for the key, returning the count within the window.
+        """
+        bucket = int(now // self.bucketWidth)
+        oldest = bucket - self.buckets + 1
+
+        slots = [slot for slot in self.counters.pop(key, ()) if slot[0] >= oldest]
+        if slots and slots[-1][0] == bucket:
+            slots[-1][1] += 1
+        else:
+            slots.append([bucket, 1])
+
+        self.counters[key] = slots
+        if len(self.counters) > self.maxKeys:
+            self.counters.popitem(last=False)
+
+        return sum(count for slotBucket, count in slots)
+
+    def remove(self, key):
+        self.counters.pop(key, None)
+
+class Rule(object):
+    """ Block a host (or its network, for a prefix under 32) once threshold
+    failed attempts, or events of any kind whose message contains match, are
+    seen within window seconds.
+    """
+
+    def __init__(self, threshold, window, prefix=32, match=None, duration=3600):
+        self.threshold = threshold
+        self.window = window
+        self.prefix = prefix
+        self.match = match
+        self.duration = duration
+        self.mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        self.counters = WindowCounters(window)
+
+    def __str__(self):
+        spec = "%d/%ds/%d" % (self.threshold, self.window, self.prefix)
+        if self.match:
+            spec += ":" + self.match
+        return spec
+
+    def key(self, ipAddress):
+        """ Return the address or network (in CIDR notation) the rule counts
+        the given address under.
+        """
+        if self.prefix == 32:
+            return ipAddress
+        address = struct.unpack("!I", socket.inet_aton(ipAddress))[0] & self.mask
+        return "%s/%d" % (socket.inet_ntoa(struct.pack("!I", address)), self.prefix)
+
+def parseRule(spec, duration=3600):
+    """ Return the rule described by THRESHOLD/WINDOW[/PREFIX][:MATCH], e.g.
+    "5/60" (5 failures in a minute from one address) or "50/600/24:Invalid user"
+    (50 invalid users in 10 minutes from one /24). The threshold and window
+    (seconds) must be at least 1.
+    """
+    counts, match = spec, None
+    if ":" in spec:
+        counts, match = spec.split(":", 1)
+
+    try:
+        parts = [int(part) for part in counts.split("/")]
+        threshold, window = parts[:2]
+        prefix = parts[2] if len(parts) > 2 else 32
+        if len(parts) > 3 or threshold < 1 or window < 1 or not 0 < prefix <= 32:
+            raise ValueError()
+    except ValueError:
+        raise ValueError("Bad rule %s (expected THRESHOLD/WINDOW[/PREFIX][:MATCH])" % repr(spec))
+
+    return Rule(threshold, window, prefix, match, duration)
+
+class IpsetProtocol(protocol.ProcessProtocol):
+    """ Feeds a script to 'ipset restore' and fires the deferred when it exits.
+    """
+
+    def __init__(self, script, deferred):
+        self.script = script
+        self.deferred = deferred
+        self.errors = ""
+
+    def connectionMade(self):
+        self.transport.write(self.script)
+        self.transport.closeStdin()
+
+    def errReceived(self, data):
+        self.errors += data
+
+    def processEnded(self, reason):
+        if reason.value.exitCode == 0:
+            self.deferred.callback(None)
+        else:
+            self.deferred.errback(RuntimeError("ipset restore failed (%s): %s" %
+                                               (reason.value.exitCode, self.errors.strip())))
+
+class IpsetExecutor(object):
+    """
+    Applies a batch of blocks with a single 'ipset restore' process. Blocks go
+    into a hash:net set (addresses and networks alike) with the block duration
+    as the ipset timeout, so the kernel expires them. The set is expected to
+    be referenced by a firewall rule, e.g.
+
+        iptables -I INPUT -m set --match-set authlog src -j DROP
+    """
+
+    def __init__(self, setName="authlog", command="/sbin/ipset"):
+        self.setName = setName
+        self.command = command
+
+    def execute(self, blocks):
+        """ Block each (address or network, seconds), returning a deferred.
+        """
+        lines = ["create %s hash:net timeout 0" % self.setName]
+        for key, duration in blocks:
+            lines.append("add %s %s timeout %d" % (self.setName, key, duration))
+
+        deferred = defer.Deferred()
+        reactor.spawnProcess(IpsetProtocol("\n".join(lines) + "\n", deferred),
+                             self.command, [self.command, "-exist", "restore"], env=None)
+        return deferred
+
+class DryRunExecutor(object):
+    """ Logs (and keeps) each batch of blocks instead of applying them.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("AuthLogWatcher")
+        self.batches = []
+
+    def execute(self, blocks):
+        self.batches.append(blocks)
+        self.logger.info("Would block: %s" % ", ".join("%s (%ds)" % block for block in blocks))
+
+class Blocklist(object):
+    """
+    Evaluates blocking rules against each event as it arrives and applies the
+    resulting blocks in batches, one executor call per flushInterval seconds
+    at most, instead of a process per address.
+
+    Blocks still in effect are remembered (up to maxBlocked) so that an
+    address is not blocked again until its block has expired.
+
+    Addresses within the allowed networks (loopback and private ranges unless
+    given) are never counted, and a rule's network is narrowed to the single
+    address rather than block an allowed network within it.
+    """
+
+    # Seconds between batches
+    flushInterval = 5
+
+    # Most blocks remembered
+    maxBlocked = 100000
+
+    def __init__(self, rules, executor, clock=None, allow=DEFAULT_ALLOW):
+        self.rules = rules
+        self.executor = executor
+        self.clock = clock or reactor
+        self.logger = logging.getLogger("AuthLogWatcher")
+
+        # [ (address, mask) ]
+        self.allowed = [parseNetwork(spec) for spec in allow]
+
+        # { address or network : seconds } waiting for the next flush
+        self.pending = collections.OrderedDict()
+
+        # { address or network : expiry time } oldest first
+        self.blocked = collections.OrderedDict()
+
+        self.blockCount = 0
+        self.flushLoop = task.LoopingCall(self.flush)
+        self.flushLoop.clock = self.clock
+
+    def start(self):
+        if not self.flushLoop.running:
+            self.flushLoop.start(self.flushInterval, now=False)
+
+    def stop(self):
+        if self.flushLoop.running:
+            self.flushLoop.stop()
+        self.flush()
+
+    def isAllowed(self, ipAddress):
+        address = parseNetwork(ipAddress)[0]
+        return any(address & mask == network for network, mask in self.allowed)
+
+    def overlapsAllowed(self, key):
+        """ Determine if the address or network (in CIDR notation) contains,
+        or is within, an allowed network.
+        """
+        address, mask = parseNetwork(key)
+        return any(address & allowedMask & mask == network & mask
+                   for network, allowedMask in self.allowed)
+
+    def addEvent(self, ipAddress, message, failure=True):
+        """ Count the event against each rule (failures only, unless the rule
+        matches on the message), queueing a block for any address (or network)
+        reaching a rule's threshold.
+        """
+        if self.isAllowed(ipAddress):
+            return
+
+        now = self.clock.seconds()
+
+        for rule in self.rules:
+            if rule.match:
+                if rule.match not in message:
+                    continue
+            elif not failure:
+                continue
+
+            key = rule.key(ipAddress)
+            if key != ipAddress and self.overlapsAllowed(key):
+                key = ipAddress
+            if key in self.pending or self.blocked.get(key, 0) > now:
+                continue
+
+            if rule.counters.add(key, now) >= rule.threshold:
+                rule.counters.remove(key)
+                self.logger.warning("Blocking %s for %ds (rule %s)" % (key, rule.duration, rule))
+                self.pending[key] = max(rule.duration, self.pending.get(key, 0))
+
+    def flush(self):
+        """ Apply the queued blocks as a single batch.
+        """
+        if not self.pending:
+            return
+
+        now = self.clock.seconds()
+        blocks = self.pending.items()
+        self.pending = collections.OrderedDict()
+
+        for key, duration in blocks:
+            self.blocked.pop(key, None)
+            self.blocked[key] = now + duration
+        while self.blocked and (len(self.blocked) > self.maxBlocked or
+                                self.blocked.itervalues().next() <= now):
+            self.blocked.popitem(last=False)
+
+        self.blockCount += len(blocks)
+        deferred = defer.maybeDeferred(self.executor.execute, blocks)
+        deferred.addErrback(self.flushFailed, blocks)
+        return deferred
+
+    def flushFailed(self, failure, blocks):
+        self.logger.critical("Could not apply %d blocks: %s" % (len(blocks),
+                                                               failure.getErrorMessage()))
+        for key, duration in blocks:
+            self.blocked.pop(key, None)
+
+    def status(self):
+        return { "rules": [str(rule) for rule in self.rules],
+                 "tracked": sum(len(rule.counters) for rule in self.rules),
+                 "pending": len(self.pending),
+                 "blocked": len(self.blocked),
+                 "blockCount": self.blockCount
+        }
@@ -0,0 +1,378 @@
+from array import array
+import collections
+import logging
+
+# NumPy is optional, queries are evaluated in pure python without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The columns holding dictionary encoded strings
+STRING_COLUMNS = ("host", "template", "source", "node", "country", "org")
+
+# Columns (and filters) which describe the host rather than the event
+HOST_COLUMNS = ("country", "org")
+
+class Dictionary(object):
+    """ Maps each distinct string of a column to a small integer id. The empty
+    string (unknown) is always id 0.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.add("")
+
+    def add(self, value):
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+    def get(self, value):
+        return self.ids.get(value)
+
+    def __len__(self):
+        return len(self.values)
+
+class EventStore(object):
+    """
+    An in-memory columnar store of events which answers filter & group-by
+    queries without scanning the full events.
+
+    Each event is a row across typed arrays: the time and, dictionary encoded,
+    the host, message template (the sanitized message), source (parser name),
+    node (the watcher, on an aggregator) and the host's country and org. The
+    country and org are filled in for all of a host's rows once the host info
+    is known.
+
+    Inverted indexes map each host, template, source and node id to the
+    (sorted) rows which hold it, and each country and org id to the hosts
+    within. A query starts from the rows of its most selective indexed filter
+    and the remaining filters are evaluated over those rows a column at a time
+    (with NumPy when it is installed).
+
+    Rows are kept in the order added. Rows can be removed (e.g. a node's
+    events replaced on an aggregator), which only marks them until a quarter
+    of the rows are removed or maxRows is reached; once maxRows is reached the
+    oldest quarter of the rows is dropped.
+    """
+
+    # Most rows held before the oldest are dropped
+    maxRows = 1000000
+
+    def __init__(self):
+        self.logger = logging.getLogger("AuthLogWatcher")
+
+        # { column : Dictionary }
+        self.dictionaries = dict((column, Dictionary()) for column in STRING_COLUMNS)
+
+        # { column : array }
+        self.columns = { "time": array('d') }
+        for column in STRING_COLUMNS:
+            self.columns[column] = array('l')
+
+        # { column : { id : array of rows } }
+        self.rowIndex = { "host": {}, "template": {}, "source": {}, "node": {} }
+
+        # { column : { id : set of host ids } }
+        self.hostIndex = { "country": {}, "org": {} }
+
+        # { host id : { column : id } }
+        self.hostValues = {}
+
+        # Number of rows dropped so far (row + offset is unique for an event)
+        self.offset = 0
+
+        # Marks the removed rows (1) not deleted yet, and their number
+        self.removed = bytearray()
+        self.removedCount = 0
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def encode(self, eventData):
+        """ Return the row values ({ column : value or id }) of the given event.
+        """
+        hostId = self.dictionaries["host"].add(eventData["host"])
+        if hostId not in self.hostValues:
+            self.setHostInfo(eventData["host"], eventData.get("hostinfo", {}))
+
+        values = { "time": eventData["time"],
+                   "host": hostId,
+                   "template": self.dictionaries["template"].add(eventData["template"]),
+                   "source": self.dictionaries["source"].add(eventData.get("source", "")),
+                   "node": self.dictionaries["node"].add(eventData.get("node", "")) }
+        values.update(self.hostValues[hostId])
+        return values
+
+    def addEvent(self, eventData):
+        """ Add a row for the given event (as published by the watcher).
+        """
+        row = len(self)
+        values = self.encode(eventData)
+
+        for column in self.columns:
+            self.columns[column].append(values[column])
+
+        for column, index in self.rowIndex.items():
+            index.setdefault(values[column], array('l')).append(row)
+        self.removed.append(0)
+
+        if len(self) > self.maxRows:
+            if self.removedCount:
+                self.compact()
+            if len(self) > self.maxRows:
+                self.dropRows(self.maxRows // 4)
+
+    def replaceRows(self, rows, events):
+        """ Remove the given rows and add the given events after the rest (e.g.
+        to replace a node's events on an aggregator). Deleting the removed rows
+        (once there are enough of them) rebuilds the store, and an export under
+        way may then miss or repeat events.
+        """
+        for row in rows:
+            row = int(row)
+            if not self.removed[row]:
+                self.removed[row] = 1
+                self.removedCount += 1
+
+        for eventData in events:
+            self.addEvent(eventData)
+
+        if self.removedCount > len(self) // 4:
+            self.compact()
+
+    def setHostInfo(self, host, hostObj):
+        """ Record the country and org of the host, updating its existing rows.
+        """
+        hostId = self.dictionaries["host"].add(host)
+        previous = self.hostValues.get(hostId, {})
+
+        values = {}
+        for column in HOST_COLUMNS:
+            values[column] = self.dictionaries[column].add(hostObj.get(column, "") or "")
+        self.hostValues[hostId] = values
+
+        if previous == values:
+            return
+
+        for column in HOST_COLUMNS:
+            if column in previous:
+                self.hostIndex[column][previous[column]].discard(hostId)
+            self.hostIndex[column].setdefault(values[column], set()).add(hostId)
+
+            for row in self.rowIndex["host"].get(hostId, ()):
+                self.columns[column][row] = values[column]
+
+    def dropRows(self, count):
+        """ Drop the oldest rows and rebuild the row indexes.
+        """
+        self.logger.info("Event store full, dropping %d oldest events" % count)
+
+        for column in self.columns:
+            del self.columns[column][:count]
+        self.removedCount -= self.removed[:count].count("\x01")
+        del self.removed[:count]
+        self.offset += count
+
+        self.compact()
+
+    def compact(self):
+        """ Delete the removed rows and rebuild the row indexes.
+        """
+        if self.removedCount:
+            if numpy:
+                keep = numpy.frombuffer(self.removed, dtype=numpy.uint8) == 0
+                for column in self.columns:
+                    values = self.columns[column]
+                    self.columns[column] = array(values.typecode,
+                                                 self.columnArray(column)[keep].tostring())
+            else:
+                keep = [row for row, removed in enumerate(self.removed) if not removed]
+                for column in self.columns:
+                    values = self.columns[column]
+                    self.columns[column] = array(values.typecode, [values[row] for row in keep])
+
+            self.removed = bytearray(len(self))
+            self.removedCount = 0
+
+        self.buildRowIndex()
+
+    def buildRowIndex(self):
+        for column, index in self.rowIndex.items():
+            index.clear()
+            if numpy:
+                # Group the rows by value id (keeping each group in row order)
+                valueIds = self.columnArray(column)
+                rows = numpy.argsort(valueIds, kind="mergesort")
+                sortedIds = valueIds[rows]
+                starts = numpy.flatnonzero(numpy.diff(sortedIds)) + 1
+                for group in numpy.split(rows.astype('l'), starts):
+                    if len(group):
+                        index[int(valueIds[group[0]])] = array('l', group.tostring())
+            else:
+                for row, valueId in enumerate(self.columns[column]):
+                    index.setdefault(valueId, array('l')).append(row)
+
+    def filterIds(self, field, values):
+        """ Return the (column, set of ids) selected by a filter on the given
+        field. Country and org filters select hosts; message filters select the
+        templates containing any of the values.
+        """
+        if field == "message":
+            templates = self.dictionaries["template"]
+            return "template", set(templates.ids[template] for template in templates.values
+                                   if template and any(value in template for value in values))
+
+        if field not in self.dictionaries:
+            raise ValueError("Unknown field %s" % repr(field))
+
+        ids = set(self.dictionaries[field].get(value) for value in values)
+        ids.discard(None)
+
+        if field in HOST_COLUMNS:
+            hostIds = set()
+            for valueId in ids:
+                hostIds.update(self.hostIndex[field].get(valueId, ()))
+            return "host", hostIds
+
+        return field, ids
+
+    def selectRows(self, filters, since=None, until=None):
+        """ Return the rows matching every filter ({ field : value or [values] })
+        and the time range, as a sorted sequence.
+        """
+        conditions = []
+        for field, values in (filters or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            conditions.append(self.filterIds(field, values))
+
+        # Start from the rows of the most selective indexed filter
+        def size(condition):
+            column, ids = condition
+            index = self.rowIndex[column]
+            return sum(len(index.get(valueId, ())) for valueId in ids)
+
+        conditions.sort(key=size)
+
+        if conditions:
+            column, ids = conditions.pop(0)
+            postings = [self.rowIndex[column][valueId] for valueId in ids
+                        if valueId in self.rowIndex[column]]
+            if numpy:
+                rows = numpy.sort(numpy.concatenate([numpy.frombuffer(posting, dtype=posting.typecode)
+                                                     for posting in postings] or [numpy.zeros(0, 'l')]))
+            else:
+                rows = sorted(row for posting in postings for row in posting)
+        elif numpy:
+            rows = numpy.arange(len(self))
+        else:
+            rows = range(len(self))
+
+        # ...and evaluate the rest a column at a time
+        if numpy:
+            for column, ids in conditions:
+                values = self.columnArray(column)[rows]
+                rows = rows[numpy.in1d(values, numpy.array(list(ids), dtype='l'))]
+
+            if since is not None or until is not None:
+                times = self.columnArray("time")[rows]
+                mask = numpy.ones(len(rows), dtype=bool)
+                if since is not None:
+                    mask &= times >= since
+                if until is not None:
+                    mask &= times < until
+                rows = rows[mask]
+
+            if self.removedCount:
+                rows = rows[numpy.frombuffer(self.removed, dtype=numpy.uint8)[rows] == 0]
+        else:
+            for column, ids in conditions:
+                values = self.columns[column]
+                rows = [row for row in rows if values[row] in ids]
+
+            if since is not None or until is not None:
+                times = self.columns["time"]
+                rows = [row for row in rows
+                        if (since is None or times[row] >= since) and
+                           (until is None or times[row] < until)]
+
+            if self.removedCount:
+                removed = self.removed
+                rows = [row for row in rows if not removed[row]]
+
+        return rows
+
+    def columnArray(self, column):
+        """ A NumPy view of the column (only valid until the next event is added).
+        """
+        values = self.columns[column]
+        return numpy.frombuffer(values, dtype=values.typecode)
+
+    def query(self, filters=None, since=None, until=None, groupBy=None, limit=100):
+        """ Answer a query over the stored events. Returns the number of
+        matching events and either the count of each distinct value of the
+        groupBy field (most common first) or the latest matching events.
+        """
+        rows = self.selectRows(filters, since, until)
+        result = { "count": len(rows) }
+
+        if groupBy:
+            if groupBy not in self.dictionaries:
+                raise ValueError("Unknown field %s" % repr(groupBy))
+
+            values = self.dictionaries[groupBy].values
+            if numpy:
+                counts = numpy.bincount(self.columnArray(groupBy)[rows], minlength=len(values))
+                groups = [(values[valueId], int(counts[valueId])) for valueId in numpy.nonzero(counts)[0]]
+            else:
+                column = self.columns[groupBy]
+                counts = collections.Counter(column[row] for row in rows)
+                groups = [(values[valueId], count) for valueId, count in counts.items()]
+
+            groups.sort(key=lambda group: group[1], reverse=True)
+            result["groups"] = groups[:limit] if limit else groups
+        else:
+            result["events"] = [self.getRow(row) for row in rows[max(0, len(rows)-limit):]]
+
+        return result
+
+    def chunks(self, chunkSize):
+        """ Generate the stored events as chunks of decoded columns
+        ({ column : sequence }). Events added once this has started are not
+        included, events dropped or removed meanwhile are skipped.
+        """
+        end = self.offset + len(self)
+        position = self.offset
+
+        while position < end:
+            start = max(position, self.offset) - self.offset
+            stop = min(end - self.offset, start + chunkSize)
+            if start >= stop:
+                return
+
+            if "\x01" in self.removed[start:stop]:
+                rows = [row for row in xrange(start, stop) if not self.removed[row]]
+                column = lambda name: array(self.columns[name].typecode,
+                                            [self.columns[name][row] for row in rows])
+            else:
+                column = lambda name: self.columns[name][start:stop]
+
+            chunk = { "time": column("time") }
+            for name in STRING_COLUMNS:
+                values = self.dictionaries[name].values
+                chunk[name] = [values[valueId] for valueId in column(name)]
+            yield chunk
+
+            position = self.offset + stop
+
+    def getRow(self, row):
+        """ Return the given row as a dictionary.
+        """
+        rowData = { "time": self.columns["time"][row] }
+        for column in STRING_COLUMNS:
+            rowData[column] = self.dictionaries[column].values[self.columns[column][row]]
+        return rowData
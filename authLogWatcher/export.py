@@ -0,0 +1,327 @@
+from twisted.internet import task
+from array import array
+import logging
+import struct
+import mmap
+import json
+import time
+import csv
+import os
+
+# NumPy and pyarrow are optional: NumPy gives zero-copy column views when
+# reading exports back, pyarrow is needed to write Parquet files
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Native columnar file layout:
+#
+#   MAGIC | column blocks ... | footer (JSON) | footer length (8 bytes) | MAGIC
+#
+# Each chunk holds one block per column, 8 byte aligned, of raw typed values
+# ('d' double, 'l' int64). String columns are stored as 'l' ids into the
+# column's dictionary in the footer, which also describes the columns and the
+# offset of every block so the file can be memory-mapped and read in place.
+MAGIC = "ALCF"
+VERSION = 1
+
+# The columns of each exported table as (name, type) where type is 'd', 'l'
+# or 'str'
+HOST_FIELDS = ("ip", "hostname", "city", "region", "country", "postal", "loc", "org")
+TABLES = {
+    "events": (("time", "d"), ("host", "str"), ("template", "str"), ("source", "str"),
+               ("node", "str"), ("country", "str"), ("org", "str")),
+    "hosts": tuple((field, "str") for field in HOST_FIELDS),
+    "aggregates": (("host", "str"), ("template", "str"), ("count", "l")),
+}
+
+class ColumnarWriter(object):
+    """ Writes chunks of columns to the native columnar format.
+    """
+    extension = "alc"
+
+    def __init__(self, path, table, columns):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.chunks = []
+        self.dictionaries = dict((name, {}) for name, columnType in columns
+                                 if columnType == "str")
+        self.handle = open(path, "wb")
+        self.handle.write(MAGIC)
+        self.align()
+
+    def align(self):
+        padding = -self.handle.tell() % 8
+        if padding:
+            self.handle.write("\0" * padding)
+
+    def encode(self, name, values):
+        """ Dictionary encode the given strings, returning an array of ids.
+        """
+        dictionary = self.dictionaries[name]
+        ids = array('l')
+        for value in values:
+            if value not in dictionary:
+                dictionary[value] = len(dictionary)
+            ids.append(dictionary[value])
+        return ids
+
+    def writeChunk(self, chunk):
+        """ Write a chunk given as { column : sequence of values }.
+        """
+        offsets = {}
+        rows = 0
+        for name, columnType in self.columns:
+            if columnType == "str":
+                values = self.encode(name, chunk[name])
+            else:
+                values = array(columnType, chunk[name])
+
+            offsets[name] = self.handle.tell()
+            values.tofile(self.handle)
+            self.align()
+            rows = len(values)
+
+        self.chunks.append({ "rows": rows, "offsets": offsets })
+
+    def close(self):
+        dictionaries = {}
+        for name, dictionary in self.dictionaries.items():
+            values = [None] * len(dictionary)
+            for value, valueId in dictionary.items():
+                values[valueId] = value
+            dictionaries[name] = values
+
+        footer = json.dumps({ "version": VERSION,
+                              "table": self.table,
+                              "columns": self.columns,
+                              "chunks": self.chunks,
+                              "dictionaries": dictionaries,
+                              "created": time.time() })
+        self.handle.write(footer)
+        self.handle.write(struct.pack("<Q", len(footer)))
+        self.handle.write(MAGIC)
+        self.handle.close()
+
+class ParquetWriter(object):
+    """ Writes chunks of columns to a Parquet file (requires pyarrow).
+    """
+    extension = "parquet"
+
+    def __init__(self, path, table, columns):
+        if pyarrow is None:
+            raise ValueError("Parquet export requires pyarrow (use the alc or csv format)")
+
+        types = { "d": pyarrow.float64(), "l": pyarrow.int64(), "str": pyarrow.string() }
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, types[columnType]) for name, columnType in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, use_dictionary=True)
+
+    def writeChunk(self, chunk):
+        arrays = [pyarrow.array(list(chunk[name]), type=self.schema.field_by_name(name).type)
+                  for name, columnType in self.columns]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+class CSVWriter(object):
+    """ Writes chunks of columns to a CSV file with a header row.
+    """
+    extension = "csv"
+
+    def __init__(self, path, table, columns):
+        self.columns = columns
+        self.handle = open(path, "wb")
+        self.writer = csv.writer(self.handle)
+        self.writer.writerow([name for name, columnType in columns])
+
+    def writeChunk(self, chunk):
+        columns = [chunk[name] for name, columnType in self.columns]
+        for row in zip(*columns):
+            self.writer.writerow([value.encode("utf-8") if isinstance(value, unicode) else value
+                                  for value in row])
+
+    def close(self):
+        self.handle.close()
+
+# { format : writer class }
+FORMATS = { "alc": ColumnarWriter, "parquet": ParquetWriter, "csv": CSVWriter }
+
+class ColumnarFile(object):
+    """
+    Reads a native columnar export by memory-mapping it, so that opening even
+    a very large export is instant. Numeric columns (and the ids of string
+    columns) are NumPy views of the mapped file when NumPy is installed.
+
+        export = ColumnarFile("exports/events-1400000000.alc")
+        export.column("time")           # [ per chunk arrays ]
+        export.strings("country")       # decoded, for all rows
+        for row in export.rows(): ...
+    """
+
+    def __init__(self, path):
+        self.handle = open(path, "rb")
+        self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC or self.map[-len(MAGIC):] != MAGIC:
+            raise ValueError("Not a columnar export: %s" % repr(path))
+
+        footerEnd = len(self.map) - len(MAGIC) - 8
+        footerLength = struct.unpack("<Q", self.map[footerEnd:footerEnd+8])[0]
+        footer = json.loads(self.map[footerEnd-footerLength:footerEnd])
+
+        self.table = footer["table"]
+        self.columns = [(name, str(columnType)) for name, columnType in footer["columns"]]
+        self.chunks = footer["chunks"]
+        self.dictionaries = footer["dictionaries"]
+        self.types = dict(self.columns)
+
+    def __len__(self):
+        return sum(chunk["rows"] for chunk in self.chunks)
+
+    def column(self, name):
+        """ Return the values of the column (ids for string columns) as a list
+        with an array per chunk.
+        """
+        typeCode = "l" if self.types[name] == "str" else self.types[name]
+        itemSize = array(typeCode).itemsize
+
+        values = []
+        for chunk in self.chunks:
+            offset = chunk["offsets"][name]
+            if numpy:
+                values.append(numpy.frombuffer(self.map, dtype=typeCode,
+                                               count=chunk["rows"], offset=offset))
+            else:
+                values.append(array(typeCode, self.map[offset:offset+chunk["rows"]*itemSize]))
+        return values
+
+    def strings(self, name):
+        """ Return the decoded values of a string column.
+        """
+        dictionary = self.dictionaries[name]
+        return [dictionary[valueId] for values in self.column(name) for valueId in values]
+
+    def rows(self):
+        """ Generate each row as a dictionary.
+        """
+        names = [name for name, columnType in self.columns]
+        for chunkIndex in xrange(len(self.chunks)):
+            columns = []
+            for name in names:
+                values = self.column(name)[chunkIndex]
+                if self.types[name] == "str":
+                    dictionary = self.dictionaries[name]
+                    values = [dictionary[valueId] for valueId in values]
+                columns.append(values)
+
+            for row in zip(*columns):
+                yield dict(zip(names, row))
+
+    def close(self):
+        self.map.close()
+        self.handle.close()
+
+class Exporter(object):
+    """
+    Exports the events, host info or aggregates (host message counts) of a
+    watcher (or aggregator) to a file in the export directory. The export is
+    streamed a chunk at a time as a cooperative task, so neither the reactor
+    is blocked nor is the whole table held in memory at once.
+    """
+
+    # Rows written per chunk (and per reactor iteration)
+    chunkSize = 65536
+
+    def __init__(self, source, exportDir):
+        self.source = source
+        self.exportDir = exportDir
+        self.logger = logging.getLogger("AuthLogWatcher")
+
+    def export(self, table, format="alc", fileName=None):
+        """ Start exporting the table, returning a deferred which fires with a
+        summary of the export once written.
+        """
+        if table not in TABLES:
+            raise ValueError("Unknown table %s (choose from %s)" % (repr(table),
+                                                                  ", ".join(sorted(TABLES))))
+        if format not in FORMATS:
+            raise ValueError("Unknown format %s (choose from %s)" % (repr(format),
+                                                                   ", ".join(sorted(FORMATS))))
+
+        writerClass = FORMATS[format]
+
+        # Exports only go to the export directory
+        if fileName is None:
+            fileName = "%s-%d.%s" % (table, time.time(), writerClass.extension)
+        if os.path.basename(fileName) != fileName or fileName.startswith("."):
+            raise ValueError("Bad export file name %s" % repr(fileName))
+
+        if not os.path.isdir(self.exportDir):
+            os.makedirs(self.exportDir)
+        path = os.path.join(self.exportDir, fileName)
+
+        writer = writerClass(path, table, TABLES[table])
+        summary = { "table": table, "format": format, "path": os.path.abspath(path), "rows": 0 }
+
+        def writeChunks():
+            for chunk in getattr(self, "%sChunks" % table)():
+                writer.writeChunk(chunk)
+                summary["rows"] += len(chunk[TABLES[table][0][0]])
+                yield
+
+        def finished(result):
+            writer.close()
+            self.logger.info("Exported %d %s to %s" % (summary["rows"], table, repr(path)))
+            return summary
+
+        def failed(failure):
+            self.logger.warning("Export to %s failed" % repr(path))
+            try:
+                writer.close()
+            except:
+                pass
+            return failure
+
+        self.logger.info("Exporting %s to %s" % (table, repr(path)))
+        deferred = task.cooperate(writeChunks()).whenDone()
+        deferred.addCallbacks(finished, failed)
+        return deferred
+
+    def eventsChunks(self):
+        return self.source.eventStore.chunks(self.chunkSize)
+
+    def hostsChunks(self):
+        hosts = sorted(self.source.hostInfo.keys())
+        for start in xrange(0, len(hosts), self.chunkSize):
+            chunk = dict((field, []) for field in HOST_FIELDS)
+            for host in hosts[start:start+self.chunkSize]:
+                hostObj = self.source.hostInfo.get(host, {})
+                for field in HOST_FIELDS:
+                    chunk[field].append(hostObj.get(field, "") or "")
+                chunk["ip"][-1] = host
+            yield chunk
+
+    def aggregatesChunks(self):
+        chunk = { "host": [], "template": [], "count": [] }
+        for host in sorted(self.source.hostMessages.keys()):
+            for template, count in self.source.hostMessages.get(host, {}).items():
+                chunk["host"].append(host)
+                chunk["template"].append(template)
+                chunk["count"].append(count)
+
+            if len(chunk["host"]) >= self.chunkSize:
+                yield chunk
+                chunk = { "host": [], "template": [], "count": [] }
+
+        if chunk["host"]:
+            yield chunk
@@ -1,7 +1,10 @@
-from twisted.internet import inotify
+from twisted.internet import inotify, reactor
 from twisted.python import filepath
 from twisted.protocols.basic import LineReceiver
 import logging
+import fnmatch
+import io
+import glob
 import abc
 import os
 
@@ -30,8 +33,29 @@ class FileWatcher(LineReceiver, object):
     # The inotify Object
     notifier = None
 
+    # Seconds to wait after a modify event before reading, so that the many
+    # modify events of a busy file are handled by a single read
+    readDelay = 0.05
+
+    # Bytes read from the file at once
+    bufferSize = 64*1024
+
+    # The most bytes read from the file before yielding to the reactor (so
+    # that a busy file cannot starve other watchers)
+    maxBytesPerRead = 256*1024
+
+    # The pending call to (continue to) read the file
+    readCall = None
+
+    # The partial line at the end of the last read
+    tail = ""
+
+    # Whether the last read stopped before the end of the file
+    behind = False
+
     def __init__(self, watchPath):
-        self.watchPath = watchPath
+        # (absolute, as are the paths of iNotify events)
+        self.watchPath = os.path.abspath(watchPath)
         self.logger = logging.getLogger()
 
     def start(self):
@@ -74,20 +98,13 @@ class FileWatcher(LineReceiver, object):
         Open a new file handle for the watch path and optionally read to the
         end of the file.
         """
-        # Attempt to close the original file gracefully (referenced by inode)
-        if self.file:
-            try:
-                self.file.close()
-            except:
-                # Catch any errors relating to closing the file as this is a readonly
-                # handle
-                pass
+        self.closeFile()
 
         try:
             self.logger.debug("Monitoring file for changes (%s)." %
                                     repr(self.watchPath))
 
-            self.file = open(self.watchPath, "r")
+            self.file = io.open(self.watchPath, "rb")
 
             # Ignore previous contents in the file just opened
             if skipToEnd:
@@ -95,14 +112,44 @@ class FileWatcher(LineReceiver, object):
 
             # Read all existing contents in the file just opened
             else:
-                for line in self.file.readlines():
-                    self.lineReceived(line.strip())
+                self.readLines()
         except:
             # This should catch any exception regarding file access
             self.logger.warning("Could not open file for monitoring (%s)." % \
                                       repr(self.watchPath),
                                       exc_info=True)
 
+    def closeFile(self):
+        """ Finish reading the file being read (if any) and close it.
+        """
+        # Finish reading the original file before it is closed, including a
+        # last line without a newline
+        if self.readCall and self.readCall.active():
+            self.readCall.cancel()
+        self.readCall = None
+
+        if self.file:
+            try:
+                while self.readBuffer():
+                    pass
+                if self.tail.strip():
+                    self.linesReceived([self.tail.strip()])
+            except:
+                self.logger.warning("Could not finish reading rolled file (%s)." %
+                                          repr(self.watchPath), exc_info=True)
+        self.tail = ""
+        self.behind = False
+
+        # Attempt to close the original file gracefully (referenced by inode)
+        if self.file:
+            try:
+                self.file.close()
+            except:
+                # Catch any errors relating to closing the file as this is a readonly
+                # handle
+                pass
+            self.file = None
+
 
     def eventReceived(self, watch, watchPath, mask):
         """ Callback when iNotify has observed a change in the watch file.
@@ -115,24 +162,22 @@ class FileWatcher(LineReceiver, object):
             # is created with the same path).
             if mask & inotify.IN_CREATE or mask & inotify.IN_MOVED_TO:
 
-                self.logger.info("Monitored file rolled (%s)." %
-                                        repr(self.watchPath))
+                # (unless the new file has been opened already, e.g. found by
+                # a FileWatcherGroup scan of its new directory)
+                if self.rolled():
+                    self.logger.info("Monitored file rolled (%s)." %
+                                            repr(self.watchPath))
 
-                self.openNewFile(skipToEnd=False)
+                    self.openNewFile(skipToEnd=False)
 
             # Data has been written to the file.
             elif mask & inotify.IN_MODIFY:
 
-                try:
-                    # Continue reading from the current position until the end of the file
-                    for line in self.file.readlines():
-
-                        self.lineReceived(line.strip())
-                except:
-                    # Any error in reading should result in no action taken
-                    self.logger.critical("Could not read data from file (%s)." % \
-                                                repr(self.watchPath),
-                                                exc_info=True)
+                # Read from the current position until the end of the file
+                # shortly, along with any other writes made meanwhile (unless a
+                # read is already scheduled)
+                if self.readCall is None:
+                    self.readCall = reactor.callLater(self.readDelay, self.readLines)
             else:
                 self.logger.debug("Monitored file event (Mask:%s Log:%s)." %
                                       (repr(mask), repr(self.watchPath)))
@@ -142,8 +187,287 @@ class FileWatcher(LineReceiver, object):
                                       (repr(mask), repr(watchPath.path.decode("utf-8"))))
 
 
+    def readLines(self):
+        """ Read lines from the current position, passing them to the lines
+        handler a buffer at a time. At most maxBytesPerRead bytes are read at
+        once, the rest are read on a later reactor iteration.
+        """
+        self.readCall = None
+        try:
+            readBytes = 0
+            while readBytes < self.maxBytesPerRead:
+                count = self.readBuffer()
+                if not count:
+                    self.behind = False
+                    return
+
+                readBytes += count
+
+            # There may be more to read, let others have a turn first
+            self.behind = True
+            self.readCall = reactor.callLater(0, self.readLines)
+        except:
+            # Any error in reading should result in no action taken
+            self.logger.critical("Could not read data from file (%s)." % \
+                                        repr(self.watchPath),
+                                        exc_info=True)
+
+    def readBuffer(self):
+        """ Read the next buffer from the file and pass on the complete lines
+        in it, keeping the partial line at the end until the next read.
+        Returns the number of bytes read.
+
+            tail | buffer .......................
+            line\\nline\\nline\\n ... line\\npartial
+            `----- linesReceived() -----'  `- tail
+        """
+        data = self.file.read(self.bufferSize)
+        if data:
+            lines = (self.tail + data).split("\n")
+            self.tail = lines.pop()
+            if lines:
+                self.linesReceived([line.strip() for line in lines])
+        return len(data)
+
+    def rolled(self):
+        """ Determine if the watch path is now a different file than the one
+        being read.
+        """
+        try:
+            current = os.stat(self.watchPath)
+        except OSError:
+            return False
+
+        if not self.file:
+            return True
+
+        opened = os.fstat(self.file.fileno())
+        return (opened.st_dev, opened.st_ino) != (current.st_dev, current.st_ino)
+
+    def backlog(self):
+        """ Return the number of bytes written to the file which have not been
+        read yet. Writes only waiting out the readDelay are not counted, as
+        the last read did reach the end of the file.
+        """
+        if self.readCall and not self.behind:
+            return 0
+        try:
+            return max(0, os.fstat(self.file.fileno()).st_size - self.file.tell())
+        except:
+            return 0
+
+    def linesReceived(self, lines):
+        """ Take action on a batch of lines observed in the log file, by
+        default passing each to lineReceived.
+        """
+        for line in lines:
+            self.lineReceived(line)
+
     @abc.abstractmethod
     def lineReceived(self, line):
         """Take a specific action on a single line observed in the log file.
         """
         pass
+
+
+class FileWatcherGroup(object):
+    """
+    Tails many files with a single iNotify instance. Each file is tailed by its
+    own FileWatcher; the parent directories are watched once and events are
+    passed to the watcher for the path in question.
+
+    Files can also be added by glob pattern, in which case a watcher is made by
+    the given factory for each match found on start and for any matching file
+    created later on (e.g. an auth.log of a new container), and closed once the
+    file or its directory is deleted or the file is moved away. The nearest
+    existing directory above the pattern is watched, along with every
+    directory below it matching the start of the pattern, so that directories
+    created later on are watched as well:
+
+        /var/lib/lxc/*/rootfs/var/log/auth.log
+        /var/lib/lxc                                (watched)
+        /var/lib/lxc/web2                           (created -> watched)
+        /var/lib/lxc/web2/rootfs/var/log/auth.log   (created -> tailed)
+
+    As with glob, a wildcard does not match across a '/'.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger()
+        self.notifier = None
+
+        # { path : FileWatcher }
+        self.watchers = {}
+
+        # [ (pattern, factory) ]
+        self.patterns = []
+
+        # set of paths tailed for matching a pattern
+        self.matched = set()
+
+        # set of watched directory paths
+        self.watchedDirs = set()
+
+    def addWatcher(self, watcher):
+        """ Tail the path of the given watcher. If the group is running then
+        the file is read from the start.
+        """
+        self.watchers[watcher.watchPath] = watcher
+        watcher.notifier = self.notifier
+
+        if self.notifier:
+            self.watchDirectory(os.path.dirname(watcher.watchPath))
+            watcher.openNewFile()
+
+    def removeWatcher(self, path):
+        """ Stop tailing the given path, reading what is left of the file first.
+        """
+        watcher = self.watchers.pop(path, None)
+        self.matched.discard(path)
+
+        if watcher:
+            self.logger.info("No longer monitoring file (%s)." % repr(path))
+            watcher.closeFile()
+
+    def addPattern(self, pattern, factory):
+        """ Tail every file matching the given glob pattern, each with the
+        FileWatcher returned by factory(path).
+        """
+        pattern = os.path.abspath(pattern)
+        self.patterns.append((pattern, factory))
+
+        if self.notifier:
+            self.startPattern(pattern, factory)
+
+    def start(self):
+        """ Register all parent directories with iNotify and start each watcher.
+        """
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+
+        for watcher in self.watchers.values():
+            watcher.notifier = self.notifier
+            self.watchDirectory(os.path.dirname(watcher.watchPath))
+            watcher.openNewFile()
+
+        for pattern, factory in self.patterns:
+            self.startPattern(pattern, factory)
+
+    def startPattern(self, pattern, factory):
+        # Start from the directories above the first wildcard...
+        parts = pattern.split("/")
+        static = []
+        for part in parts[:-1]:
+            if glob.has_magic(part):
+                break
+            static.append(part)
+        rootPath = "/".join(static) or "/"
+
+        # ...or the nearest of those which exists
+        while not os.path.isdir(rootPath) and os.path.dirname(rootPath) != rootPath:
+            rootPath = os.path.dirname(rootPath)
+
+        self.scanDirectory(rootPath)
+
+    def scanDirectory(self, dirPath):
+        """ Watch the directory and tail any files within matching a pattern,
+        descending into the directories which match the start of a pattern.
+        """
+        self.watchDirectory(dirPath)
+
+        try:
+            names = sorted(os.listdir(dirPath))
+        except OSError:
+            self.logger.warning("Could not list directory (%s)." % repr(dirPath),
+                                exc_info=True)
+            return
+
+        for name in names:
+            self.pathCreated(os.path.join(dirPath, name))
+
+    def pathCreated(self, path):
+        """ Tail the path if it is a file matching a pattern, or scan it if it
+        is a directory which may hold matching files.
+        """
+        # A file of a directory created again (e.g. a rebuilt container) is
+        # opened again
+        if path in self.watchers:
+            if self.watchers[path].rolled():
+                self.watchers[path].openNewFile()
+            return
+
+        if os.path.isdir(path):
+            if any(matchPattern(path, pattern, partial=True) for pattern, factory in self.patterns):
+                self.scanDirectory(path)
+            return
+
+        for pattern, factory in self.patterns:
+            if matchPattern(path, pattern):
+                self.logger.info("New file matching %s (%s)." %
+                                    (repr(pattern), repr(path)))
+                self.addWatcher(factory(path))
+                self.matched.add(path)
+                return
+
+    def watchDirectory(self, dirPath):
+        """ Watch the directory with iNotify (once) for changes to the files within.
+        """
+        if dirPath in self.watchedDirs:
+            return
+
+        self.watchedDirs.add(dirPath)
+
+        # Paths of directories created later on come from iNotify as unicode
+        if isinstance(dirPath, unicode):
+            dirPath = dirPath.encode("utf-8")
+        self.notifier.watch(filepath.FilePath(dirPath),
+                                  callbacks=[self.eventReceived])
+
+    def eventReceived(self, watch, watchPath, mask):
+        """ Callback when iNotify has observed a change in a watched directory,
+        which is passed to the watcher of the file in question.
+        """
+        path = watchPath.path.decode("utf-8")
+
+        # The watch of a deleted directory is gone, it is watched again if
+        # the directory is created again. Files matching a pattern which are
+        # gone are no longer tailed (a rolled file is tailed again once created).
+        if mask & inotify.IN_DELETE_SELF:
+            self.watchedDirs.discard(path)
+            for matchedPath in [matchedPath for matchedPath in self.matched
+                                if matchedPath.startswith(path.rstrip("/") + "/")]:
+                self.removeWatcher(matchedPath)
+            return
+
+        if path in self.matched and mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.removeWatcher(path)
+            return
+
+        if path not in self.watchers and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            if self.patterns:
+                self.pathCreated(path)
+            if path in self.watchers:
+                return
+
+        watcher = self.watchers.get(path)
+        if watcher:
+            watcher.eventReceived(watch, watchPath, mask)
+        else:
+            self.logger.debug("General file event (Mask:%s Log:%s)." %
+                                      (repr(mask), repr(path)))
+
+def matchPattern(path, pattern, partial=False):
+    """ Determine if the path matches the glob pattern, one path component at
+    a time (so that a wildcard does not match a '/'). With partial, a path
+    matching the leading components of the pattern (i.e. a directory which
+    may hold matches) is also a match.
+    """
+    pathParts = path.rstrip("/").split("/")
+    patternParts = pattern.rstrip("/").split("/")
+
+    if len(pathParts) > len(patternParts) or \
+       (len(pathParts) < len(patternParts) and not partial):
+        return False
+
+    return all(fnmatch.fnmatchcase(pathPart, patternPart)
+               for pathPart, patternPart in zip(pathParts, patternParts))
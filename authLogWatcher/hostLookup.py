@@ -0,0 +1,291 @@
+from twisted.internet import reactor, task, threads
+import collections
+import requests
+import logging
+import heapq
+
+# Where host information is fetched from
+LOOKUP_URL = "http://ipinfo.io/%s/json"
+
+class LookupFailed(Exception):
+    """ Raised (in the lookup thread) when the provider gave no usable answer.
+    The provider flag notes if the failure was the provider's fault (rate
+    limiting, server errors, timeouts) rather than something about the address.
+    """
+
+    def __init__(self, message, provider=True):
+        super(LookupFailed, self).__init__(message)
+        self.provider = provider
+
+class HostLookup(object):
+    """
+    Schedules host information lookups against ipinfo.io so that a failing or
+    rate-limiting provider is not hammered once per auth.log line.
+
+    Lookups are made off the reactor thread. Addresses which fail are kept in a
+    negative cache and retried with an exponential backoff per address, until
+    maxAttempts have failed; the address is then not looked up again for
+    forgetAfter seconds. All lookups share a token bucket rate limiter, and
+    repeated provider failures open a circuit breaker which pauses all lookups
+    for a cooldown period. Addresses which could not be looked up right away
+    are queued (pending) and looked up by a background sweep, which also
+    queues the addresses whose backoff has passed (retries); once a record is
+    fetched the callback is invoked with (ipAddress, hostInfo).
+
+      lookup(ip) ---> cached / backing off / given up? ---> done
+                         |
+                         x ---> no tokens / breaker open ---> pending <---- retries
+                         |                                      |              ^
+                         x ---> fetch (thread) <-- requeue() ---x              |
+                                  |                                            |
+                                  x ---> success: store + callback             |
+                                  x ---> failure: backoff ---------------------x
+
+    The pending queue and the negative cache are bounded, dropping the oldest
+    addresses (which are looked up afresh if seen again).
+    """
+
+    # Seconds before the first retry of a failed address, doubled for each
+    # further failure up to maxBackoff
+    baseBackoff = 30
+    maxBackoff = 6*60*60
+
+    # Failed lookups of an address before giving up on it, and the seconds
+    # until a given up address may be looked up again
+    maxAttempts = 10
+    forgetAfter = 24*60*60
+
+    # Most addresses queued to be looked up, and kept in the negative cache
+    maxPending = 10000
+    maxBackoffEntries = 100000
+
+    # Token bucket: sustained lookups per second and the allowed burst
+    rate = 1.0
+    burst = 5
+
+    # Consecutive provider failures which open the breaker, and how long
+    # (seconds) the breaker stays open
+    breakerThreshold = 5
+    breakerCooldown = 5*60
+
+    # Seconds between sweeps of the pending addresses
+    requeueInterval = 5
+
+    # Seconds to wait on the provider before giving up
+    requestTimeout = 10
+
+    def __init__(self, hostInfo, callback, clock=None):
+        self.hostInfo = hostInfo
+        self.callback = callback
+        self.clock = clock or reactor
+        self.logger = logging.getLogger("AuthLogWatcher")
+
+        # { host : (failures, nextAttempt) } least recently failed first
+        self.backoff = collections.OrderedDict()
+
+        # [ (nextAttempt, host) ] heap of hosts backing off
+        self.retries = []
+
+        # hosts ready to be looked up (oldest first) and hosts being fetched
+        # right now
+        self.pending = collections.OrderedDict()
+        self.inFlight = set()
+
+        # rate limiter & circuit breaker state
+        self.tokens = float(self.burst)
+        self.lastRefill = self.clock.seconds()
+        self.providerFailures = 0
+        self.breakerOpenUntil = 0
+
+        # Whether the breaker has opened since the last successful lookup
+        self.halfOpen = False
+
+        self.requeueLoop = task.LoopingCall(self.requeue)
+        self.requeueLoop.clock = self.clock
+
+    def start(self):
+        """ Start the background sweep of pending lookups.
+        """
+        if not self.requeueLoop.running:
+            self.requeueLoop.start(self.requeueInterval, now=False)
+
+    def stop(self):
+        """ Stop the background sweep of pending lookups.
+        """
+        if self.requeueLoop.running:
+            self.requeueLoop.stop()
+
+    def lookup(self, ipAddress):
+        """ Request host info for the given address. Nothing is done if the
+        address is known, already being fetched, waiting to be looked up,
+        backing off or given up on.
+        """
+        if ipAddress in self.hostInfo or ipAddress in self.inFlight:
+            return
+
+        if ipAddress in self.pending:
+            return
+
+        if ipAddress in self.backoff:
+            failures, nextAttempt = self.backoff[ipAddress]
+            if self.clock.seconds() < nextAttempt:
+                return
+            if failures >= self.maxAttempts:
+                del self.backoff[ipAddress]
+
+        if not self.breakerOpen() and self.takeToken():
+            self.fetch(ipAddress)
+        else:
+            self.addPending(ipAddress)
+
+    def addPending(self, ipAddress):
+        self.pending[ipAddress] = None
+        if len(self.pending) > self.maxPending:
+            self.pending.popitem(last=False)
+
+    def requeue(self):
+        """ Queue the addresses out of their backoff period, and look up the
+        queued addresses for as long as the rate limiter allows.
+        """
+        now = self.clock.seconds()
+
+        # Forget the addresses given up on long enough ago (or left backing
+        # off long after their retry was due, once dropped from pending)
+        while self.backoff:
+            failures, nextAttempt = self.backoff.itervalues().next()
+            if failures < self.maxAttempts:
+                nextAttempt += self.forgetAfter
+            if nextAttempt > now:
+                break
+            self.backoff.popitem(last=False)
+
+        if self.breakerOpen():
+            return
+
+        while self.retries and self.retries[0][0] <= now:
+            nextAttempt, ipAddress = heapq.heappop(self.retries)
+
+            # Skip retries made stale by a later failure or a lookup since
+            if self.backoff.get(ipAddress, (0, None))[1] != nextAttempt:
+                continue
+            if ipAddress not in self.hostInfo and ipAddress not in self.inFlight:
+                self.addPending(ipAddress)
+
+        while self.pending:
+            ipAddress = self.pending.iterkeys().next()
+            if ipAddress in self.hostInfo:
+                del self.pending[ipAddress]
+                continue
+
+            if not self.takeToken():
+                break
+
+            del self.pending[ipAddress]
+            self.fetch(ipAddress)
+
+    def waiting(self):
+        """ Return the number of lookups ready to be made (or being made), not
+        counting addresses backing off, nor any queued until the provider has
+        recovered from opening the breaker.
+        """
+        if self.breakerOpen() or self.halfOpen:
+            return len(self.inFlight)
+        return len(self.pending) + len(self.inFlight)
+
+    def breakerOpen(self):
+        return self.clock.seconds() < self.breakerOpenUntil
+
+    def takeToken(self):
+        """ Take a token from the rate limiter bucket, returning False if there
+        are none left.
+        """
+        now = self.clock.seconds()
+        self.tokens = min(float(self.burst),
+                          self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def fetch(self, ipAddress):
+        """ Fetch the host info in a thread and handle the result on the reactor.
+        """
+        self.inFlight.add(ipAddress)
+        deferred = threads.deferToThread(self.request, ipAddress)
+        deferred.addCallbacks(self.lookupSucceeded, self.lookupFailed,
+                              callbackArgs=(ipAddress,), errbackArgs=(ipAddress,))
+        return deferred
+
+    def request(self, ipAddress):
+        """ Make the HTTP request (called from a thread).
+        """
+        try:
+            retObj = requests.get(LOOKUP_URL % ipAddress, timeout=self.requestTimeout)
+        except requests.RequestException as error:
+            raise LookupFailed("Error while fetching IP Info: %s" % repr(error))
+
+        if retObj.status_code != 200:
+            provider = retObj.status_code == 429 or retObj.status_code >= 500
+            raise LookupFailed("HTTP %d response while fetching IP Info!" %
+                               retObj.status_code, provider=provider)
+
+        return retObj.json()
+
+    def lookupSucceeded(self, hostObj, ipAddress):
+        self.inFlight.discard(ipAddress)
+        self.backoff.pop(ipAddress, None)
+        self.providerFailures = 0
+        self.halfOpen = False
+
+        self.hostInfo[ipAddress] = hostObj
+        self.callback(ipAddress, hostObj)
+
+    def lookupFailed(self, failure, ipAddress):
+        self.inFlight.discard(ipAddress)
+
+        provider = True
+        if failure.check(LookupFailed):
+            provider = failure.value.provider
+            self.logger.warning("%s (%s)" % (failure.getErrorMessage(), ipAddress))
+        else:
+            self.logger.warning("Error while fetching IP Info! (%s)\n%s" %
+                                (ipAddress, failure.getTraceback()))
+
+        # Back off from this host (or give up on it)...
+        now = self.clock.seconds()
+        failures = self.backoff.pop(ipAddress, (0, 0))[0] + 1
+        if failures >= self.maxAttempts:
+            self.logger.warning("Giving up on IP Info for %s after %d attempts." %
+                                (ipAddress, failures))
+            self.backoff[ipAddress] = (failures, now + self.forgetAfter)
+        else:
+            delay = min(self.maxBackoff, self.baseBackoff * 2 ** (failures - 1))
+            self.backoff[ipAddress] = (failures, now + delay)
+            heapq.heappush(self.retries, (now + delay, ipAddress))
+
+        while len(self.backoff) > self.maxBackoffEntries:
+            self.backoff.popitem(last=False)
+
+        # ...and from the provider if it keeps failing
+        if provider:
+            self.providerFailures += 1
+            if self.providerFailures >= self.breakerThreshold:
+                self.logger.warning("IP Info provider failing, pausing lookups for %ds." %
+                                    self.breakerCooldown)
+                self.breakerOpenUntil = self.clock.seconds() + self.breakerCooldown
+                self.providerFailures = 0
+                self.halfOpen = True
+
+    def status(self):
+        """ Return a summary of the lookup state.
+        """
+        return { "pending": len(self.pending),
+                 "inFlight": len(self.inFlight),
+                 "backingOff": len(self.backoff),
+                 "retries": len(self.retries),
+                 "waiting": self.waiting(),
+                 "breakerOpen": self.breakerOpen()
+        }
@@ -0,0 +1,141 @@
+from twisted.internet import reactor, task
+import logging
+
+# Shedding levels, each includes the degradations of the levels below
+NORMAL = 0
+SKIP_ENRICHMENT = 1   # no host lookups or per-line logging for known hosts
+SAMPLE_PUBLISHING = 2 # only a sample of events is published to clients
+COUNT_ONLY = 3        # repeat messages are only counted
+
+LEVEL_NAMES = { NORMAL: "normal",
+                SKIP_ENRICHMENT: "skip-enrichment",
+                SAMPLE_PUBLISHING: "sample-publishing",
+                COUNT_ONLY: "count-only" }
+
+class LoadShedder(object):
+    """
+    Detects when lines arrive faster than they are processed and picks a
+    shedding level which the watcher degrades its work by. The counters
+    (hostMessages and eventCount) are kept exact at every level.
+
+    The load is measured every checkInterval seconds from:
+        lag      seconds since the log files were last read to the end
+        backlog  bytes written to the log files but not read yet
+        lookups  host lookups ready to be made (not those backing off)
+    The level goes up as soon as any threshold of a higher level is passed and
+    comes down one level at a time, once the thresholds of the current level
+    have not been reached for recoveryChecks checks in a row.
+    """
+
+    # Seconds between load checks
+    checkInterval = 1
+
+    # Checks in a row under the thresholds before stepping down a level
+    recoveryChecks = 10
+
+    # Publish one in sampleRate events while sampling
+    sampleRate = 10
+
+    # { level : (lag seconds, backlog bytes, pending lookups) }
+    thresholds = { SKIP_ENRICHMENT: (2, 256*1024, 200),
+                   SAMPLE_PUBLISHING: (5, 1024*1024, 1000),
+                   COUNT_ONLY: (15, 8*1024*1024, 5000) }
+
+    def __init__(self, measure, callback, clock=None):
+        """ measure() returns the current (backlog bytes, pending lookups),
+        callback(status) is called whenever the level changes.
+        """
+        self.measure = measure
+        self.callback = callback
+        self.clock = clock or reactor
+        self.logger = logging.getLogger("AuthLogWatcher")
+
+        self.level = NORMAL
+        self.lag = 0
+        self.backlog = 0
+        self.lookups = 0
+        self.caughtUp = self.clock.seconds()
+        self.quietChecks = 0
+
+        # events skipped since the last one published while sampling
+        self.skipped = 0
+
+        self.checkLoop = task.LoopingCall(self.check)
+        self.checkLoop.clock = self.clock
+
+    def start(self):
+        if not self.checkLoop.running:
+            self.checkLoop.start(self.checkInterval, now=False)
+
+    def stop(self):
+        if self.checkLoop.running:
+            self.checkLoop.stop()
+
+    def exceeds(self, level):
+        maxLag, maxBacklog, maxLookups = self.thresholds[level]
+        return self.lag >= maxLag or self.backlog >= maxBacklog or self.lookups >= maxLookups
+
+    def check(self):
+        """ Measure the load and update the shedding level.
+        """
+        now = self.clock.seconds()
+        self.backlog, self.lookups = self.measure()
+
+        if self.backlog == 0:
+            self.caughtUp = now
+        self.lag = now - self.caughtUp
+
+        level = NORMAL
+        for candidate in sorted(self.thresholds):
+            if self.exceeds(candidate):
+                level = candidate
+
+        if level > self.level:
+            self.quietChecks = 0
+            self.setLevel(level)
+        elif self.level > NORMAL and not self.exceeds(self.level):
+            self.quietChecks += 1
+            if self.quietChecks >= self.recoveryChecks:
+                self.quietChecks = 0
+                self.setLevel(self.level - 1)
+        else:
+            self.quietChecks = 0
+
+    def setLevel(self, level):
+        self.logger.warning("Load shedding level %s -> %s (lag %ds, backlog %d bytes, %d lookups)" %
+                            (LEVEL_NAMES[self.level], LEVEL_NAMES[level],
+                             self.lag, self.backlog, self.lookups))
+        self.level = level
+        self.callback(self.status())
+
+    def skipEnrichment(self):
+        return self.level >= SKIP_ENRICHMENT
+
+    def countOnly(self):
+        return self.level >= COUNT_ONLY
+
+    def sample(self):
+        """ Return the number of events the next published event stands for,
+        or 0 if this event should not be published.
+        """
+        self.skipped += 1
+        if self.level >= SAMPLE_PUBLISHING and self.skipped < self.sampleRate:
+            return 0
+
+        weight, self.skipped = self.skipped, 0
+        return weight
+
+    def countOnlyEvent(self):
+        """ Note an event which was only counted, so that the next published
+        event stands for it as well.
+        """
+        self.skipped += 1
+
+    def status(self):
+        return { "type": "load",
+                 "level": self.level,
+                 "name": LEVEL_NAMES[self.level],
+                 "lag": self.lag,
+                 "backlog": self.backlog,
+                 "lookups": self.lookups
+        }
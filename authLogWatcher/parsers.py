@@ -0,0 +1,118 @@
+import abc
+import re
+
+# Patterns shared between parsers
+ipPattern = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+portPattern = re.compile(r'.* port (?P<port>\d+).*')
+quotedPattern = re.compile(r"['\"].+['\"]")
+bracketedPattern = re.compile(r"<[^>]*>")
+
+class LineParser(object):
+    """
+    Parses a single log line from a daemon into an event. Subclasses give a
+    line pattern with a 'message' group which selects lines of interest; the
+    message is then searched for a remote IP address and "sanitized" (the
+    address, port and any user supplied values are removed) so that similar
+    messages from the same host are counted together.
+
+    parse() returns a tuple of (ipAddress, message, sanitizedMessage) or None
+    if the line is of no interest. isFailure(message) tells failed attempts
+    (which blocking rules count) from other events such as successful logins
+    and disconnects.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    # The name of the parser used to refer to it in configuration
+    name = None
+
+    # Selects the lines of interest, must have a 'message' group
+    linePattern = None
+
+    # Patterns of message parts which are removed when sanitizing
+    sanitizePatterns = (quotedPattern,)
+
+    # Selects the messages of failed attempts (None if every line of interest
+    # is a failure)
+    failurePattern = None
+
+    def parse(self, line):
+        lineMatch = self.linePattern.search(line)
+
+        if not lineMatch:
+            return None
+
+        message = lineMatch.group('message')
+        sanitizedMessage = message
+        for pattern in self.sanitizePatterns:
+            sanitizedMessage = pattern.sub('', sanitizedMessage)
+
+        # Determine if there is an IP address in the line
+        ipMatch = ipPattern.search(message)
+        if not ipMatch:
+            return None
+
+        ipAddress = ipMatch.group(0)
+        sanitizedMessage = ipPattern.sub('', sanitizedMessage)
+
+        # Determine if there is an IP port in the line
+        portMatch = portPattern.search(message)
+        if portMatch:
+            sanitizedMessage = sanitizedMessage.replace(portMatch.group('port'), "")
+
+        return ipAddress, message, sanitizedMessage
+
+    def isFailure(self, message):
+        """ Determine if the (parsed) message is of a failed attempt.
+        """
+        return self.failurePattern is None or bool(self.failurePattern.search(message))
+
+class SshdParser(LineParser):
+    """ OpenSSH server lines (auth.log / secure).
+    """
+    name = "sshd"
+    linePattern = re.compile(r'.*sshd\[\d+\]: (?P<message>.*)')
+    failurePattern = re.compile(r'Failed |[Ii]nvalid user|[Aa]uthentication failure|'
+                                r'Did not receive identification|Bad protocol version|'
+                                r'[Uu]nable to negotiate|not allowed because|'
+                                r'authenticating user|maximum authentication attempts|'
+                                r'POSSIBLE BREAK-IN')
+
+class VsftpdParser(LineParser):
+    """ vsftpd lines, both through syslog and vsftpd's own log.
+    """
+    name = "vsftpd"
+    linePattern = re.compile(r'.*(?:vsftpd\[\d+\]:|\[pid \d+\]) (?P<message>.*)')
+    sanitizePatterns = (quotedPattern, re.compile(r"\[[^\]]*\] "))
+    failurePattern = re.compile(r'FAIL')
+
+class DovecotParser(LineParser):
+    """ Dovecot login and auth lines.
+    """
+    name = "dovecot"
+    linePattern = re.compile(r'.*dovecot(?:\[\d+\])?: (?P<message>.*(?:rip=|auth).*)')
+    sanitizePatterns = (quotedPattern, bracketedPattern,
+                        re.compile(r"\d+ attempts in \d+ secs"),
+                        re.compile(r"session=\S*"))
+    failurePattern = re.compile(r'auth failed|[Aa]uthentication failure|unknown user|'
+                                r'[Pp]assword mismatch')
+
+class NginxAuthParser(LineParser):
+    """ Authentication failures in the nginx error log.
+    """
+    name = "nginx"
+    linePattern = re.compile(r'.*\[error\] \d+#\d+: \*\d+ (?P<message>.*(?:user|password).*)')
+    sanitizePatterns = (re.compile(r", server: .*"), quotedPattern)
+
+# { name : parser class }
+PARSERS = dict((parser.name, parser) for parser in (SshdParser,
+                                                     VsftpdParser,
+                                                     DovecotParser,
+                                                     NginxAuthParser))
+
+def getParser(name):
+    """ Return a new parser given the parser name.
+    """
+    if name not in PARSERS:
+        raise ValueError("Unknown parser %s (choose from %s)" % (repr(name),
+                                                               ", ".join(sorted(PARSERS))))
+    return PARSERS[name]()
@@ -19,3 +19,19 @@ class Publisher(object):
         self.unsubscribe(key)
         self.logger.info( "New Subscriber: %s" % repr(key))
         self.subscribers[key] = subscriber
+
+    def publish(self, method, data, exact=None):
+        """ Call the given method on every subscriber with the given data,
+        dropping any subscribers which fail. If exact is given then only
+        subscribers which need every event (exact=True, e.g. aggregators) or
+        only those which can be given a sample (exact=False) are called.
+        """
+        for key, subscriber in self.subscribers.items():
+            if exact is not None and getattr(subscriber, "exact", False) != exact:
+                continue
+            try:
+                getattr(subscriber, method)(data)
+            except:
+                # unsubscribe dead clients
+                self.logger.warning("Dead client: %s" % repr(key))
+                self.unsubscribe(key)
@@ -2,6 +2,8 @@ from twisted.web import xmlrpc
 import xmlrpclib
 import operator
 
+import export
+
 class XMLRPCSubscriber(object):
     """ Represents a client which is subscribing to content over XMLRPC. The
     client serves a XMLRPC port which the auth.log watcher uses to send
@@ -14,13 +16,20 @@ class XMLRPCSubscriber(object):
     def sendEvent(self, data):
         self.server.event(data)
 
+    def sendHostUpdate(self, data):
+        self.server.hostUpdated(data)
+
+    def sendLoadLevel(self, data):
+        self.server.loadChanged(data)
+
 class AuthXMLRPCResponder(xmlrpc.XMLRPC, object):
     """ The published API over RPC to facilitate auth log subscriptions.
     """
 
-    def __init__(self, watcher):
+    def __init__(self, watcher, exportDir="exports"):
         super(AuthXMLRPCResponder, self).__init__(allowNone=True)
         self.watcher = watcher
+        self.exporter = export.Exporter(watcher, exportDir)
 
     def xmlrpc_ping(self):
         return "pong"
@@ -37,9 +46,52 @@ class AuthXMLRPCResponder(xmlrpc.XMLRPC, object):
         return self.watcher.hostInfo
 
     def xmlrpc_getEventHistory(self, length):
-        if len(self.watcher.eventHistory) > length:
-            return self.watcher.eventHistory[-length:]
-        return self.watcher.eventHistory
+        """ The latest events, with the host info known now (which may have
+        been fetched since the event was published).
+        """
+        history = self.watcher.eventHistory
+        if len(history) > length:
+            history = history[-length:]
+        hostInfo = self.watcher.hostInfo
+        return [dict(eventData, hostinfo=hostInfo[eventData["host"]])
+                if eventData["host"] in hostInfo else eventData
+                for eventData in history]
+
+    def xmlrpc_query(self, query):
+        """ Query the event store, see EventStore.query() for the fields of
+        the given query dictionary.
+        """
+        try:
+            return self.watcher.eventStore.query(filters=query.get("filters"),
+                                                 since=query.get("since"),
+                                                 until=query.get("until"),
+                                                 groupBy=query.get("groupBy"),
+                                                 limit=query.get("limit", 100))
+        except ValueError as error:
+            return xmlrpc.Fault(8002, str(error))
+
+    def xmlrpc_export(self, table, format="alc", fileName=None):
+        """ Export a table (events, hosts or aggregates) to a file in the
+        export directory on the server, returning a summary once written.
+        """
+        try:
+            return self.exporter.export(table, format, fileName)
+        except ValueError as error:
+            return xmlrpc.Fault(8003, str(error))
+
+    def xmlrpc_getBlocklistStatus(self):
+        if not getattr(self.watcher, "blocklist", None):
+            return xmlrpc.Fault(8004, "No blocking rules are configured.")
+        return self.watcher.blocklist.status()
+
+    def xmlrpc_getLoadStatus(self):
+        return self.watcher.getLoadStatus()
+
+    def xmlrpc_getSources(self):
+        return self.watcher.getSources()
+
+    def xmlrpc_getLookupStatus(self):
+        return self.watcher.hostLookup.status()
 
     # Facilitating subscriptions to clients
 
@@ -48,3 +100,13 @@ class AuthXMLRPCResponder(xmlrpc.XMLRPC, object):
 
     def xmlrpc_unsubscribe(self, url, port):
         self.watcher.unsubscribe( (url, port) )
+
+class AggregatorXMLRPCResponder(AuthXMLRPCResponder):
+    """ The same API served by an Aggregator (in place of the watcher).
+    """
+
+    def xmlrpc_getNodes(self):
+        return self.watcher.getNodes()
+
+    def xmlrpc_getLookupStatus(self):
+        return xmlrpc.Fault(8001, "Host lookups are made by the watchers, not the aggregator.")
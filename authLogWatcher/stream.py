@@ -0,0 +1,157 @@
+from twisted.internet import protocol
+from twisted.protocols.basic import LineReceiver
+import logging
+import json
+
+# Snapshots of the data stores are sent as a single line
+MAX_LINE_LENGTH = 256*1024*1024
+
+class JSONLineProtocol(LineReceiver):
+    """ Exchanges JSON messages (dictionaries with a 'type') one per line.
+    Received messages are dispatched to the message_<type>() method.
+    """
+    delimiter = "\n"
+    MAX_LENGTH = MAX_LINE_LENGTH
+
+    def sendMessage(self, message):
+        self.transport.write(json.dumps(message) + self.delimiter)
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            handler = getattr(self, "message_%s" % message["type"], None)
+        except:
+            self.logger.warning("Bad message from %s" % repr(self.transport.getPeer()),
+                                exc_info=True)
+            return
+
+        if handler:
+            handler(message)
+        else:
+            self.logger.debug("Unhandled message type %s" % repr(message["type"]))
+
+    def lineLengthExceeded(self, line):
+        self.logger.warning("Message too long from %s" % repr(self.transport.getPeer()))
+        self.transport.loseConnection()
+
+class EventStreamProtocol(JSONLineProtocol):
+    """
+    Streams events from the AuthLogWatcher to an aggregator over a persistent
+    connection. The aggregator subscribes with the epoch and sequence number
+    of the last event it has seen from this watcher; if the missed events are
+    still in the event history they are replayed, otherwise a snapshot of the
+    data stores is sent first. Live events and host updates follow.
+
+    AuthLogWatcher                       Aggregator
+         | <---- subscribe(epoch, seq) ----- |
+         | ----- hello -------------------> |
+         | ----- snapshot / replay -------> |
+    ---> x (event)                           |
+         | ----- event -------------------> |
+         | <---- hostinfo (shared) -------- |
+         ...                                ...
+    """
+
+    # Aggregators are sent every event, even when shedding load
+    exact = True
+
+    def connectionMade(self):
+        self.logger = logging.getLogger("AuthLogWatcher")
+        self.watcher = self.factory.watcher
+
+        peer = self.transport.getPeer()
+        self.key = ("stream", peer.host, peer.port)
+
+    def connectionLost(self, reason):
+        self.watcher.unsubscribe(self.key)
+
+    def message_subscribe(self, message):
+        watcher = self.watcher
+
+        self.sendMessage({ "type": "hello",
+                           "node": self.factory.nodeName,
+                           "epoch": watcher.epoch,
+                           "seq": watcher.sequence,
+                           "sources": watcher.getSources()
+        })
+
+        history = watcher.eventHistory
+        seq = message.get("seq", 0)
+        sameEpoch = message.get("epoch") == watcher.epoch
+
+        replay = []
+        if sameEpoch:
+            for eventData in reversed(history):
+                if eventData["seq"] <= seq:
+                    break
+                replay.append(eventData)
+            replay.reverse()
+
+        # Catch up from the history when every missed event is there (events
+        # which were only counted under load are not)...
+        if sameEpoch and seq <= watcher.sequence and len(replay) == watcher.sequence - seq:
+            self.logger.info("Stream %s catching up %d events" % (repr(self.key), len(replay)))
+
+            replayHosts = set(eventData["host"] for eventData in replay)
+            hostInfo = dict((host, watcher.hostInfo[host]) for host in replayHosts
+                            if host in watcher.hostInfo)
+
+            if hostInfo:
+                self.sendMessage({ "type": "hostinfo", "hostinfo": hostInfo })
+            for eventData in replay:
+                self.sendEvent(eventData)
+
+        # ...otherwise start over
+        else:
+            self.logger.info("Stream %s sent snapshot" % repr(self.key))
+
+            self.sendMessage({ "type": "snapshot",
+                               "epoch": watcher.epoch,
+                               "seq": watcher.sequence,
+                               "eventCount": watcher.eventCount,
+                               "hostMessages": watcher.hostMessages,
+                               "hostInfo": watcher.hostInfo,
+                               "history": history
+            })
+
+        self.sendLoadLevel(watcher.getLoadStatus())
+        watcher.subscribe(self.key, self)
+
+    def message_hostinfo(self, message):
+        self.watcher.addSharedHostInfo(message["hostinfo"])
+
+    def sendMessage(self, message):
+        # An aggregator missing a message would silently fall behind, drop the
+        # connection instead so that it reconnects and catches up
+        try:
+            JSONLineProtocol.sendMessage(self, message)
+        except:
+            self.logger.warning("Could not send to stream %s, closing it" % repr(self.key),
+                                exc_info=True)
+            self.transport.loseConnection()
+            raise
+
+    # Subscriber methods
+
+    def sendEvent(self, data):
+        self.sendMessage({ "type": "event", "event": data })
+
+    def sendCount(self, data):
+        self.sendMessage(data)
+
+    def sendLoadLevel(self, data):
+        self.sendMessage(data)
+
+    def sendHostUpdate(self, data):
+        self.sendMessage({ "type": "hostinfo",
+                           "hostinfo": { data["host"]: data["hostinfo"] }
+        })
+
+class EventStreamFactory(protocol.ServerFactory):
+    """ Accepts event stream connections from aggregators.
+    """
+    protocol = EventStreamProtocol
+
+    def __init__(self, watcher, nodeName):
+        self.watcher = watcher
+        self.nodeName = nodeName
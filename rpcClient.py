@@ -1,36 +1,156 @@
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from random import randint
+import collections
 import threading
 import xmlrpclib
 import operator
 import argparse
 import logging
 import Queue
+import time
 import sys
 import os
 
 HISTORY_LENGTH = 500
 
+# Put on a caller's queue to tell it there are no more events
+CLOSED = object()
+
+class SubscriberSet(object):
+    """
+    The queues of the callers reading events, along with the recent event
+    history. Callers come and go from any thread (or greenlet, when gevent
+    has patched threading) while events are being delivered from the XMLRPC
+    server thread, so all changes are made under a lock. Adding and removing
+    a queue is O(1); delivery copies the queues under the lock and puts the
+    event outside of it.
+
+    A new queue is given the history under the same lock that events are
+    recorded under, so a caller sees each event exactly once and in order.
+    Host updates are applied to the events of the host in the history, so a
+    caller added after the update still gets the host info with the events.
+    """
+
+    def __init__(self, historyLength=HISTORY_LENGTH):
+        self.lock = threading.Lock()
+
+        # { id(queue) : queue }
+        self.queues = {}
+
+        self.history = collections.deque(maxlen=historyLength)
+
+        # { host : latest host info } least recently updated first
+        self.hosts = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.queues)
+
+    def add(self, queue):
+        """ Add the queue, filling it with the history first.
+        """
+        with self.lock:
+            for eventData in self.history:
+                self.put(queue, eventData)
+            self.queues[id(queue)] = queue
+
+    def remove(self, queue):
+        with self.lock:
+            self.queues.pop(id(queue), None)
+
+    def setHistory(self, history):
+        """ Replace the history with the given events (fetched from the server),
+        keeping any events received since that are not in it.
+        """
+        with self.lock:
+            fetched = set((eventData.get("node"), eventData.get("seq")) for eventData in history)
+            received = [eventData for eventData in self.history
+                        if (eventData.get("node"), eventData.get("seq")) not in fetched]
+            self.history.clear()
+            self.history.extend(self.withHostInfo(eventData) for eventData in history)
+            self.history.extend(received)
+
+    def getHistory(self):
+        with self.lock:
+            return list(self.history)
+
+    def deliver(self, data, record=False):
+        """ Give the data to every queue, optionally recording it in the history.
+        """
+        with self.lock:
+            if record:
+                self.history.append(data)
+            queues = self.queues.values()
+
+        for queue in queues:
+            self.put(queue, data)
+
+    def updateHost(self, data):
+        """ Give the host update to every queue, and apply it to the events of
+        the host in the history.
+        """
+        host, hostInfo = data.get("host"), data.get("hostinfo")
+
+        with self.lock:
+            self.hosts.pop(host, None)
+            self.hosts[host] = hostInfo
+            while len(self.hosts) > self.history.maxlen:
+                self.hosts.popitem(last=False)
+
+            indexes = [index for index, eventData in enumerate(self.history)
+                       if eventData.get("host") == host]
+            for index in indexes:
+                self.history[index] = dict(self.history[index], hostinfo=hostInfo)
+
+            queues = self.queues.values()
+
+        for queue in queues:
+            self.put(queue, data)
+
+    def withHostInfo(self, eventData):
+        # The event with the latest host info known for its host
+        hostInfo = self.hosts.get(eventData.get("host"))
+        if hostInfo is None or eventData.get("hostinfo") == hostInfo:
+            return eventData
+        return dict(eventData, hostinfo=hostInfo)
+
+    def close(self):
+        """ Remove every queue, waking its reader.
+        """
+        with self.lock:
+            queues = self.queues.values()
+            self.queues.clear()
+
+        for queue in queues:
+            self.put(queue, CLOSED)
+
+    def put(self, queue, data):
+        # A reader too slow to keep up with a bounded queue misses events
+        try:
+            queue.put_nowait(data)
+        except Queue.Full:
+            pass
+
 class AuthLogClient(threading.Thread):
     """ Acts as a client to the AuthLogWatcher. This client class is responsible
     for starting subscriptions over the XMLRPC connection hosted by the server
     and providing another XMLRPC connection for the server to respond with (served
     on a random port in another thread). As events are received external callers
     can get the latest events from the getEvents() generator. Each external
-    caller uses an independent queue for storing events before they are read.
+    caller uses an independent queue for storing events before they are read
+    (see SubscriberSet).
     """
 
     def __init__(self, model):
         super(AuthLogClient, self).__init__()
         self.daemon = True
         self.model = model
-        self.eventHistory = list()
         self.eventCount = 0
+        self.loadStatus = None
         self.logger = logging.getLogger("AuthLogClient")
 
         # Provide a channel of communication to receive events
         self.host, self.port = 'localhost', randint(5000,20000)
-        self.queues = list()
+        self.subscribers = SubscriberSet()
         self.server = SimpleXMLRPCServer((self.host, self.port), logRequests=False, allow_none=True)
 
     def subscribe(self):
@@ -45,26 +165,32 @@ class AuthLogClient(threading.Thread):
         """
         self.model.unsubscribe(self.host, self.port)
         self.server.server_close()
+        self.subscribers.close()
+
+    @property
+    def eventHistory(self):
+        return self.subscribers.getHistory()
 
-    def getEvents(self, queue):
+    def getEvents(self, queue=None):
         """ A generator function which returns a single auth.log event at a time
         from the server. The given queue is used for the caller only, in this way
         multiple callers can be serviced without having to share the same queue
         (otherwise the callers would round-robin the queue when pulling events).
         """
 
-        # Each new caller gets a queue
-        self.queues.append(queue)
-
-        # Add known history to the queue for the caller to fetch
-        for eventData in self.eventHistory:
-            queue.put(eventData)
+        # Each new caller gets a queue, starting with the known history
+        if queue is None:
+            queue = Queue.Queue()
+        self.subscribers.add(queue)
 
         # Allow the reader to keep getting events as they arrive.
         try:
             while True:
                 try:
-                    yield queue.get(block=True, timeout=1)
+                    eventData = queue.get(block=True, timeout=1)
+                    if eventData is CLOSED:
+                        return
+                    yield eventData
                 except Queue.Empty:
                     pass
                 except GeneratorExit:
@@ -80,15 +206,24 @@ class AuthLogClient(threading.Thread):
     def removeQueue(self, queue):
         """ Remove the queue from the set of active queues.
         """
-        if queue in self.queues:
-            self.queues.remove(queue)
+        self.subscribers.remove(queue)
 
     def event(self, data):
         """ And event from the server over RPC has arrived!
         """
-        self.eventCount += 1
-        for queue in self.queues:
-            queue.put(data)
+        self.eventCount += data.get("weight", 1)
+        self.subscribers.deliver(data, record=True)
+
+    def loadChanged(self, data):
+        """ The server's load shedding level has changed!
+        """
+        self.loadStatus = data
+        self.subscribers.deliver(data)
+
+    def hostUpdated(self, data):
+        """ Newly fetched host info from the server over RPC has arrived!
+        """
+        self.subscribers.updateHost(data)
 
     def run(self):
         """ Subscription management thread run method.
@@ -99,14 +234,18 @@ class AuthLogClient(threading.Thread):
 
         # Expose a function
         self.server.register_function(self.event)
+        self.server.register_function(self.hostUpdated)
+        self.server.register_function(self.loadChanged)
 
         try:
             self.logger.info( "Subscribed to auth.log events! (%s:%d)" % (self.host, self.port))
 
             # Load history
-            self.eventHistory = self.model.getEventHistory(HISTORY_LENGTH)
-            self.eventCount += self.model.getEventCount() - len(self.eventHistory)
-            self.logger.info( "Fetched History: %d" % len(self.eventHistory))
+            eventHistory = self.model.getEventHistory(HISTORY_LENGTH)
+            self.subscribers.setHistory(eventHistory)
+            self.eventCount += self.model.getEventCount() - len(eventHistory)
+            self.loadStatus = self.model.getLoadStatus()
+            self.logger.info( "Fetched History: %d" % len(eventHistory))
             self.logger.info( "Total Events: %d" % self.eventCount)
 
             # Listen for RPC events
@@ -121,10 +260,10 @@ class AuthLogClient(threading.Thread):
 
 
 class AuthLogModel(object):
-    """ Represents data fetched from the server (AuthLogWatcher).
+    """ Represents data fetched from the server (AuthLogWatcher or Aggregator).
     """
-    def __init__(self):
-        self.server = xmlrpclib.Server('http://localhost:7080/')
+    def __init__(self, address='localhost:7080'):
+        self.server = xmlrpclib.Server('http://%s/' % address)
 
         # play a game for fun!
         if self.server.ping() != "pong":
@@ -137,6 +276,10 @@ class AuthLogModel(object):
         self.unsubscribe = self.server.unsubscribe
         self.getEventHistory = self.server.getEventHistory
         self.getEventCount = self.server.getEventCount
+        self.getNodes = self.server.getNodes
+        self.getLoadStatus = self.server.getLoadStatus
+        self.query = self.server.query
+        self.export = self.server.export
 
 class AuthLogView(object):
     """ Takes data from the model and massages a presentable string to display.
@@ -176,7 +319,7 @@ class AuthLogView(object):
             hostItems = []
             for item in ("country", "region", "city", "org"):
                 hostValue = "??"
-                hostObj = hostInfo[host]
+                hostObj = hostInfo.get(host, {})
                 if item in hostObj and len(hostObj[item].strip()) > 0:
                     hostValue = hostObj[item]
                 hostItems.append(hostValue)
@@ -195,6 +338,34 @@ class AuthLogView(object):
 
             print hostInfoStr
 
+    def showQuery(self, result):
+        if "groups" in result:
+            print "    %-7s %s" % ("Count", "Value")
+            print "    %-7s %s" % ("-------", "-"*50)
+            for value, count in result["groups"]:
+                print "    %7d: %s" % (count, repr(value) if value else "??")
+        else:
+            for event in result["events"]:
+                eventTime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event["time"]))
+                print "%s %-15s %-2s %-30s %s" % (eventTime, event["host"],
+                                                  event["country"] or "??",
+                                                  event["org"][:30] or "??",
+                                                  repr(event["template"]))
+
+        print
+        print result["count"], "Events"
+
+    def showNodes(self, nodes):
+        print "%-30s %-22s %-9s %10s %8s %s" % ("Node", "Address", "Connected",
+                                                "Events", "Hosts", "Last Seen")
+        for node in sorted(nodes, key=operator.itemgetter("node")):
+            lastSeen = "never"
+            if node["lastSeen"]:
+                lastSeen = "%ds ago" % (time.time() - node["lastSeen"])
+            print "%-30s %-22s %-9s %10d %8d %s" % (node["node"], node["address"],
+                                                    node["connected"], node["eventCount"],
+                                                    node["hosts"], lastSeen)
+
 
 
 
@@ -210,12 +381,16 @@ Valid commands:
    summary    Show a summary of hosts in the auth log (Default)
    country    Show the breakdown of entries by country
    subscribe  Show json events as they occur in realtime
+   nodes      Show the watchers feeding an aggregator
+   query      Filter and group the event history (see query -h)
+   export     Export events, hosts or aggregates to a file on the server
 ''')
         parser.add_argument('command', nargs='?', default="summary", help='Subcommand to run')
+        parser.add_argument('--server', default='localhost:7080',
+                            help='Address of the watcher or aggregator (default localhost:7080)')
 
-        # parse_args defaults to [1:] for args, but you need to
-        # exclude the rest of the args too, or validation will fail
-        args = parser.parse_args(sys.argv[1:2])
+        # subcommands parse the rest of the args themselves
+        args, self.commandArgs = parser.parse_known_args(sys.argv[1:])
 
         if not hasattr(self, args.command):
             print 'Unrecognized command'
@@ -224,7 +399,7 @@ Valid commands:
 
         # Setup the RPC connection
         self.presenter = AuthLogView()
-        self.model = AuthLogModel()
+        self.model = AuthLogModel(args.server)
 
         # Dispatch the command to a method
         getattr(self, args.command)()
@@ -255,6 +430,56 @@ Valid commands:
             print "Done!"
         print "Exiting."
 
+    def nodes(self):
+        self.presenter.showNodes(self.model.getNodes())
+
+    def query(self):
+        parser = argparse.ArgumentParser(
+            description='Filter and group the event history. Filters on different '
+                        'fields must all match; a filter given more than once matches any value.')
+        for field in ("host", "country", "org", "source", "node", "message", "template"):
+            parser.add_argument('--'+field, action='append')
+        parser.add_argument('--since', type=float, metavar='SECONDS',
+                            help='Only events from the last SECONDS seconds')
+        parser.add_argument('--until', type=float, metavar='SECONDS',
+                            help='Only events from before the last SECONDS seconds')
+        parser.add_argument('--group-by', choices=("host", "country", "org", "source", "node", "template"),
+                            help='Count the events for each value of the field')
+        parser.add_argument('--limit', type=int, default=100,
+                            help='Most events (or groups) to show (default 100)')
+        args = parser.parse_args(self.commandArgs)
+
+        filters = {}
+        for field in ("host", "country", "org", "source", "node", "message", "template"):
+            if getattr(args, field):
+                filters[field] = getattr(args, field)
+
+        query = { "filters": filters, "limit": args.limit }
+        if args.since is not None:
+            query["since"] = time.time() - args.since
+        if args.until is not None:
+            query["until"] = time.time() - args.until
+        if args.group_by:
+            query["groupBy"] = args.group_by
+
+        self.presenter.showQuery(self.model.query(query))
+
+    def export(self):
+        parser = argparse.ArgumentParser(
+            description='Export a table to a file in the export directory of the server.')
+        parser.add_argument('table', choices=("events", "hosts", "aggregates"))
+        parser.add_argument('--format', choices=("alc", "parquet", "csv"), default="alc",
+                            help='alc: columnar & memory-mappable (default), '
+                                 'parquet: needs pyarrow on the server, csv')
+        parser.add_argument('--name', help='File name (default <table>-<time>.<format>)')
+        args = parser.parse_args(self.commandArgs)
+
+        if args.name:
+            summary = self.model.export(args.table, args.format, args.name)
+        else:
+            summary = self.model.export(args.table, args.format)
+        print "Exported %d %s to %s" % (summary["rows"], summary["table"], summary["path"])
+
     """
     def commit(self):
         parser = argparse.ArgumentParser(
@@ -10,6 +10,7 @@ gevent.monkey.patch_all()
 
 # All others...
 from flask import Flask, request, Response, render_template, send_from_directory
+import argparse
 import sys
 import json
 import Queue
@@ -43,16 +44,18 @@ def eventStream():
     clientId = generateId()
     streamLogger.info("Streaming to client: %s" % repr(clientId))
 
-    queue = Queue.Queue()
+    # Bounded so a stalled browser cannot hold on to every event
+    queue = Queue.Queue(maxsize=4*rpcClient.HISTORY_LENGTH)
 
-    event = { "eventCount": client.eventCount }
+    event = { "eventCount": client.eventCount, "load": client.loadStatus }
     responseStr = "event: init\ndata: "+json.dumps(event)+"\n\n"
     yield responseStr
 
     try:
         for event in client.getEvents(queue):
             if event:
-                responseStr = "event: auth\ndata: "+json.dumps(event)+"\n\n"
+                eventType = event.get("type", "auth")
+                responseStr = "event: "+eventType+"\ndata: "+json.dumps(event)+"\n\n"
                 yield responseStr
     except GeneratorExit:
         raise
@@ -87,8 +90,13 @@ def page():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve auth.log events to a web frontend.')
+    parser.add_argument('--server', default='localhost:7080',
+                        help='Address of the watcher or aggregator (default localhost:7080)')
+    args = parser.parse_args()
+
     # subscribe to the auth.log events
-    model = rpcClient.AuthLogModel()
+    model = rpcClient.AuthLogModel(args.server)
     client = rpcClient.AuthLogClient(model)
     client.subscribe()
 
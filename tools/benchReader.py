@@ -0,0 +1,136 @@
+""" Benchmark of tailing log files (fileWatcher.FileWatcher): the buffered
+reader (readBuffer/linesReceived, with modify events coalesced) against the
+previous path reading a line at a time with readline on every modify event.
+
+    python tools/benchReader.py                  # 400k sshd lines
+    python tools/benchReader.py --lines 1000000 --repeat 5
+
+Three cases are timed, on the same generated file:
+    read    read the file and pass on the lines
+    parse   as read, parsing each line with the sshd parser
+    writes  single line writes, each followed by a modify event
+"""
+import argparse
+import tempfile
+import time
+import sys
+import io
+import os
+
+argParser = argparse.ArgumentParser(description='Benchmark reading log files.')
+argParser.add_argument('--lines', type=int, default=400000,
+                       help='Lines in the generated log file (default 400000)')
+argParser.add_argument('--writes', type=int, default=100000,
+                       help='Single line writes timed (default 100000)')
+argParser.add_argument('--repeat', type=int, default=3,
+                       help='Runs of each case, the best is shown (default 3)')
+args = argParser.parse_args()
+
+from twisted.internet import inotify, task
+from twisted.python import filepath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from authLogWatcher import fileWatcher, parsers
+
+LINE = "Oct 19 10:%02d:%02d host sshd[%d]: Failed password for invalid user u%d from 10.%d.%d.%d port %d ssh2\n"
+
+class BufferedWatcher(fileWatcher.FileWatcher):
+    """ The current reader, counting (and optionally parsing) the lines.
+    """
+    parser = None
+
+    def __init__(self, watchPath):
+        fileWatcher.FileWatcher.__init__(self, watchPath)
+        self.count = 0
+
+    def lineReceived(self, line):
+        self.count += 1
+        if self.parser:
+            self.parser.parse(line)
+
+class ReadlineWatcher(BufferedWatcher):
+    """ The previous reader: every modify event reads right away, a line at a
+    time, at most maxLinesPerRead lines per reactor iteration.
+    """
+    maxLinesPerRead = 500
+
+    def eventReceived(self, watch, watchPath, mask):
+        if mask & inotify.IN_MODIFY and self.readCall is None:
+            self.readLines()
+
+    def readLines(self):
+        self.readCall = None
+        for count in xrange(self.maxLinesPerRead):
+            line = self.file.readline()
+            if not line:
+                return
+            self.lineReceived(line.strip())
+
+        self.readCall = fileWatcher.reactor.callLater(0, self.readLines)
+
+READERS = (("readline", ReadlineWatcher, "r"), ("buffered", BufferedWatcher, "rb"))
+
+def makeWatcher(watcherClass, mode, path, parser=None):
+    """ Return a watcher of the path reading from the start on a fake clock.
+    """
+    clock = task.Clock()
+    fileWatcher.reactor = clock
+
+    watcher = watcherClass(path)
+    watcher.parser = parser
+    watcher.file = open(path, mode) if mode == "r" else io.open(path, mode)
+    return watcher, clock
+
+def timeRead(watcherClass, mode, path, parser=None):
+    watcher, clock = makeWatcher(watcherClass, mode, path, parser)
+
+    started = time.time()
+    watcher.readLines()
+    while watcher.readCall:
+        clock.advance(0)
+    return watcher.count, time.time() - started
+
+def timeWrites(watcherClass, mode, path, perTick=1000):
+    """ Write single lines, each followed by a modify event, letting the clock
+    run for the read delay every perTick writes.
+    """
+    open(path, "w").close()
+    watcher, clock = makeWatcher(watcherClass, mode, path)
+    modified = filepath.FilePath(path)
+
+    started = time.time()
+    with open(path, "a", 0) as handle:
+        for write in xrange(args.writes):
+            handle.write(LINE % (0, 0, write, 0, 1, 2, 3, 22))
+            watcher.eventReceived(None, modified, inotify.IN_MODIFY)
+            if write % perTick == perTick - 1:
+                clock.advance(fileWatcher.FileWatcher.readDelay)
+
+    while watcher.readCall:
+        clock.advance(fileWatcher.FileWatcher.readDelay)
+    return watcher.count, time.time() - started
+
+def best(run):
+    return min((run() for repeat in xrange(args.repeat)), key=lambda result: result[1])
+
+handle, path = tempfile.mkstemp(suffix=".log")
+try:
+    with os.fdopen(handle, "w") as logFile:
+        for line in xrange(args.lines):
+            logFile.write(LINE % (line % 60, line % 60, line, line % 500, line % 250,
+                                  line % 200, line % 100, 1000 + line % 9000))
+    size = os.path.getsize(path)
+    print "%d lines (%.1f MB), best of %d" % (args.lines, size / 1e6, args.repeat)
+
+    for case, parser in (("read", None), ("parse", parsers.getParser("sshd"))):
+        for name, watcherClass, mode in READERS:
+            count, seconds = best(lambda: timeRead(watcherClass, mode, path, parser))
+            print "  %-6s %-9s %8d lines %7.3fs %10.0f lines/s %6.1f MB/s" % \
+                  (case, name, count, seconds, count / seconds, size / seconds / 1e6)
+
+    for name, watcherClass, mode in READERS:
+        count, seconds = best(lambda: timeWrites(watcherClass, mode, path))
+        print "  %-6s %-9s %8d lines %7.3fs %10.0f lines/s" % \
+              ("writes", name, count, seconds, count / seconds)
+finally:
+    os.remove(path)
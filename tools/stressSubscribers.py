@@ -0,0 +1,97 @@
+""" Stress test of the client subscriber registry (rpcClient.SubscriberSet):
+many readers open and close streams while events and host updates are
+delivered, checking that each stream sees the events in order without gaps
+and that no stream is left behind.
+
+    python tools/stressSubscribers.py              # with threads
+    python tools/stressSubscribers.py --gevent     # with gevent (as sseClient.py)
+"""
+import argparse
+import sys
+import os
+
+argParser = argparse.ArgumentParser(description='Stress test the client subscriber registry.')
+argParser.add_argument('--gevent', action='store_true',
+                       help='Patch threading with gevent first (as the SSE client does)')
+argParser.add_argument('--readers', type=int, default=20,
+                       help='Concurrent readers (default 20)')
+argParser.add_argument('--streams', type=int, default=300,
+                       help='Streams opened and closed by each reader (default 300)')
+args = argParser.parse_args()
+
+if args.gevent:
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+import threading
+import random
+import Queue
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import rpcClient
+
+subscribers = rpcClient.SubscriberSet(historyLength=50)
+stopped = threading.Event()
+errors = []
+sent = [0]
+
+def deliver():
+    """ Deliver numbered events (and now and then a host update) until stopped.
+    """
+    seq = 0
+    while not stopped.is_set():
+        seq += 1
+        host = "10.0.0.%d" % (seq % 50)
+        subscribers.deliver({ "seq": seq, "host": host, "hostinfo": { "ip": host } }, record=True)
+        if seq % 7 == 0:
+            subscribers.updateHost({ "type": "host", "host": host,
+                                     "hostinfo": { "ip": host, "loc": "0,0" } })
+        sent[0] = seq
+
+        # Let the readers have a turn
+        if seq % 50 == 0:
+            time.sleep(0)
+
+def read():
+    """ Open and close streams, each reading a few events, checking that the
+    events of each stream are in order and without gaps.
+    """
+    for stream in xrange(args.streams):
+        queue = Queue.Queue()
+        subscribers.add(queue)
+
+        seqs = []
+        for count in xrange(random.randint(1, 60)):
+            try:
+                eventData = queue.get(timeout=1)
+            except Queue.Empty:
+                break
+            if "seq" in eventData:
+                seqs.append(eventData["seq"])
+
+        subscribers.remove(queue)
+
+        if seqs and seqs != range(seqs[0], seqs[0] + len(seqs)):
+            errors.append(seqs[:10])
+
+delivery = threading.Thread(target=deliver)
+delivery.start()
+
+readers = [threading.Thread(target=read) for reader in xrange(args.readers)]
+started = time.time()
+for reader in readers:
+    reader.start()
+for reader in readers:
+    reader.join()
+
+stopped.set()
+delivery.join()
+
+print "%s: %d streams opened and closed, %d events, %d errors, %d streams left (%.1fs)" % \
+      ("gevent" if args.gevent else "threads", args.readers * args.streams, sent[0],
+       len(errors), len(subscribers), time.time() - started)
+for seqs in errors[:5]:
+    print "  out of order: %s" % seqs
+
+sys.exit(1 if errors or len(subscribers) else 0)